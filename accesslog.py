@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PigFly, Open Source Google Search Solution
+#    Copyright (C) 2014-2020 WENS FOOD GROUP (<http://www.wens.com.cn>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#    Authored by Shengli Hu <hushengli@gmail.com>
+__author__ = 'Shengli Hu'
+__all__ = ['AccessLog', 'read_records', 'read_queries']
+
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+if sys.version_info[0] > 2:
+    from queue import Queue, Empty, Full
+else:
+    from Queue import Queue, Empty, Full
+
+# Query lines written by SearchHandler to the tornado log, before the
+# access log existed.
+log_search = re.compile(r'\tsearch for:\t(.*)$')
+
+
+class AccessLog(object):
+    """
+    JSON lines request log written by a background thread.
+
+    Records are handed over through a bounded queue, so the request path
+    never touches the disk. The writer collects them in batches and rotates
+    the file once it grows past C{max_bytes}. Without a path the records
+    go to the logging module instead, still from the writer thread.
+    """
+
+    def __init__(self, path=None, max_bytes=64 * 1024 * 1024, backups=5,
+                 batch=256, interval=1.0, queue_size=10000):
+        """
+        @type  path: str
+        @param path: Log file. Use C{None} to log through the logging module.
+
+        @type  max_bytes: int
+        @param max_bytes: Size the log file is rotated at.
+
+        @type  backups: int
+        @param backups: Rotated files kept, as path.1 ... path.N.
+
+        @type  batch: int
+        @param batch: Maximum records written at once.
+
+        @type  interval: float
+        @param interval: Maximum seconds a record waits in the queue.
+
+        @type  queue_size: int
+        @param queue_size: Records queued before new ones are dropped.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.batch = batch
+        self.interval = interval
+        self.queue = Queue(queue_size)
+        self.dropped = 0
+        self.stream = None
+        self.thread = None
+
+    def write(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='accesslog')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        """
+        Write out what is still queued and stop the writer.
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        running = True
+        while running:
+            records = list()
+            deadline = time.time() + self.interval
+            while len(records) < self.batch:
+                try:
+                    record = self.queue.get(timeout=max(0, deadline - time.time()))
+                except Empty:
+                    break
+                if record is None:
+                    running = False
+                    break
+                records.append(record)
+            if records:
+                try:
+                    self.flush(records)
+                except Exception:
+                    logging.exception('accesslog: cannot write %d records', len(records))
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def flush(self, records):
+        lines = [json.dumps(record, ensure_ascii=False, sort_keys=True) for record in records]
+        if self.path is None:
+            for line in lines:
+                logging.info(line)
+            return
+        data = u'\n'.join(lines).encode('utf-8') + b'\n'
+        if self.stream is None:
+            self.stream = open(self.path, 'ab')
+        self.stream.write(data)
+        self.stream.flush()
+        if self.stream.tell() >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        self.stream.close()
+        self.stream = None
+        for i in range(self.backups - 1, 0, -1):
+            source = '%s.%d' % (self.path, i)
+            if os.path.exists(source):
+                os.rename(source, '%s.%d' % (self.path, i + 1))
+        if self.backups:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+
+# Read back the records of an access log file, skipping damaged lines.
+def read_records(path):
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                yield json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+
+
+# Read back the search queries of an access log file or tornado log.
+def read_queries(path):
+    with open(path, 'rb') as f:
+        for line in f:
+            line = line.decode('utf-8', 'replace').rstrip(u'\r\n')
+            if line.startswith(u'{'):
+                try:
+                    query = json.loads(line).get('query')
+                except ValueError:
+                    continue
+            else:
+                m = log_search.search(line)
+                query = m and m.group(1)
+            if query:
+                yield query
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PigFly, Open Source Google Search Solution
+#    Copyright (C) 2014-2020 WENS FOOD GROUP (<http://www.wens.com.cn>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#    Authored by Shengli Hu <hushengli@gmail.com>
+__author__ = 'Shengli Hu'
+__all__ = ['Overloaded', 'Admission']
+
+import time
+
+from collections import OrderedDict, deque
+
+import tornado.ioloop
+
+from tornado.concurrent import Future
+
+from upstream import TokenBucket
+
+
+class Overloaded(IOError):
+    """
+    The search was turned away to keep the server responsive.
+    """
+
+    def __init__(self, message, retry_after=1.0):
+        IOError.__init__(self, message)
+        self.retry_after = retry_after
+
+
+class Admission(object):
+    """
+    Admission control for the searches that have to go upstream.
+
+    At most C{capacity} of them run at once, the others wait in a FIFO
+    queue of C{queue_size}. A search is turned away at once if the queue is
+    full, or if the expected wait would take it past its deadline. Every
+    client also has its own token bucket, so a single client cannot take
+    the whole capacity.
+
+    Only used from the IOLoop thread.
+    """
+
+    def __init__(self, capacity=8, queue_size=32, rate=0.5, burst=10, clients=10000):
+        """
+        @type  capacity: int
+        @param capacity: Searches running at once.
+
+        @type  queue_size: int
+        @param queue_size: Searches waiting for a slot.
+
+        @type  rate: float
+        @param rate: Searches per second allowed to each client.
+
+        @type  burst: int
+        @param burst: Searches each client may send in a burst.
+
+        @type  clients: int
+        @param clients: Client buckets kept, least recently seen dropped first.
+        """
+        self.capacity = capacity
+        self.queue_size = queue_size
+        self.rate = rate
+        self.burst = burst
+        self.clients = clients
+        self.active = 0
+        self.waiters = deque()
+        self.buckets = OrderedDict()
+        self.service = 1.0
+        self.rejected = 0
+
+    def bucket(self, client):
+        bucket = self.buckets.pop(client, None)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+        self.buckets[client] = bucket
+        while len(self.buckets) > self.clients:
+            self.buckets.popitem(last=False)
+        return bucket
+
+    def wait_estimate(self):
+        """
+        @rtype:  float
+        @return: Seconds a search joining the queue now is expected to wait.
+        """
+        return (len(self.waiters) + 1) * self.service / max(1, self.capacity)
+
+    def reject(self, message, retry_after):
+        self.rejected += 1
+        raise Overloaded(message, retry_after)
+
+    def acquire(self, client=None, deadline=None):
+        """
+        Ask for a slot.
+
+        @type  client: str
+        @param client: Address of the client, C{None} to skip its bucket.
+
+        @type  deadline: float
+        @param deadline: Time the search must be done by.
+
+        @rtype:  Future
+        @return: Resolves to the time the slot was granted, to be given back
+            to L{release}. Fails with L{Overloaded} if the deadline passes
+            while waiting.
+
+        @raise Overloaded: The search is turned away at once.
+        """
+        bucket = None
+        if client is not None:
+            bucket = self.bucket(client)
+            self.check(client, bucket, 1)
+
+        future = Future()
+        if self.active < self.capacity and not self.waiters:
+            self.active += 1
+            future.set_result(time.time())
+        else:
+            wait = self.wait_estimate()
+            if len(self.waiters) >= self.queue_size:
+                self.reject('search queue full', wait)
+            if deadline is not None and time.time() + wait > deadline:
+                self.reject('search would miss its deadline', wait)
+            entry = [future, None]
+            if deadline is not None:
+                entry[1] = tornado.ioloop.IOLoop.current().call_at(deadline, self.expire, entry)
+            self.waiters.append(entry)
+
+        if bucket is not None:
+            bucket.spend(1)
+        return future
+
+    def check(self, client, bucket, cost):
+        if not bucket.allows(cost):
+            self.reject('too many searches from %s' % client,
+                        (cost - bucket.available()) / self.rate)
+
+    def charge(self, client, cost=1):
+        """
+        Count work other than a search against the bucket of a client,
+        without taking a slot.
+
+        @raise Overloaded: The client has no tokens left for it.
+        """
+        if client is None:
+            return
+        bucket = self.bucket(client)
+        self.check(client, bucket, cost)
+        bucket.spend(cost)
+
+    def expire(self, entry):
+        try:
+            self.waiters.remove(entry)
+        except ValueError:
+            return
+        self.rejected += 1
+        entry[0].set_exception(Overloaded('search timed out in the queue', self.wait_estimate()))
+
+    def release(self, started):
+        """
+        Give a slot back and hand it over to the next search waiting.
+        """
+        now = time.time()
+        self.service = 0.8 * self.service + 0.2 * (now - started)
+        if self.waiters:
+            future, timeout = self.waiters.popleft()
+            if timeout is not None:
+                tornado.ioloop.IOLoop.current().remove_timeout(timeout)
+            future.set_result(now)
+        else:
+            self.active -= 1
+
+    def stats(self):
+        return {'active': self.active, 'queued': len(self.waiters),
+                'rejected': self.rejected, 'service': round(self.service, 3)}
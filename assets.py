@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PigFly, Open Source Google Search Solution
+#    Copyright (C) 2014-2020 WENS FOOD GROUP (<http://www.wens.com.cn>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#    Authored by Shengli Hu <hushengli@gmail.com>
+__author__ = 'Shengli Hu'
+__all__ = ['DiskCache', 'asset_key']
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from collections import OrderedDict
+
+
+# Name of the cache file of an asset URL.
+def asset_key(url):
+    if not isinstance(url, bytes):
+        url = url.encode('utf-8')
+    return hashlib.sha1(url).hexdigest()
+
+
+# Whether the process with the given pid is running.
+def process_alive(pid):
+    try:
+        os.kill(int(pid), 0)
+    except ValueError:
+        return False
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class DiskCache(object):
+    """
+    Least recently used cache of small files, bounded by their total size.
+
+    Each entry is one file: a JSON header line with the content type and
+    ETag, then the body. Files are written under a temporary name and
+    renamed, so readers never see half an entry. The recency order lives
+    in memory and is rebuilt from the file times when the cache is opened.
+    """
+
+    def __init__(self, path='cache/assets', max_bytes=256 * 1024 * 1024):
+        """
+        @type  path: str
+        @param path: Folder of the cache files, created if missing.
+
+        @type  max_bytes: int
+        @param max_bytes: Total size of the files before the least recently
+            used ones are removed.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._index = OrderedDict()
+
+    def __len__(self):
+        return len(self._index)
+
+    def filename(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def open(self):
+        """
+        Index the files left by a previous run, oldest first.
+        """
+        entries = list()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        for folder, dirs, files in os.walk(self.path):
+            for name in files:
+                filename = os.path.join(folder, name)
+                if '.' in name:
+                    # Left over by a write that did not finish, unless its
+                    # worker is still running, e.g. during a restart.
+                    if not process_alive(name.split('.')[1]):
+                        os.remove(filename)
+                    continue
+                try:
+                    with open(filename, 'rb') as f:
+                        header = json.loads(f.readline().decode('utf-8'))
+                    stat = os.stat(filename)
+                except (IOError, OSError, ValueError):
+                    continue
+                entries.append((stat.st_mtime, name, stat.st_size, header['etag']))
+        entries.sort()
+        with self._lock:
+            self._index.clear()
+            self.size = 0
+            for mtime, key, size, etag in entries:
+                self._index[key] = (size, etag)
+                self.size += size
+        self.evict()
+
+    def etag(self, key):
+        """
+        @rtype:  str
+        @return: ETag of the entry, without reading its file, or C{None}.
+        """
+        with self._lock:
+            entry = self._index.get(key)
+        return entry and entry[1]
+
+    def get(self, key):
+        """
+        @rtype:  tuple
+        @return: Body and header of the entry, or C{None} if not cached.
+        """
+        with self._lock:
+            entry = self._index.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._index[key] = entry
+            self.hits += 1
+        filename = self.filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                header = json.loads(f.readline().decode('utf-8'))
+                body = f.read()
+            # Keep the recency order across restarts.
+            os.utime(filename, None)
+        except (IOError, OSError, ValueError):
+            self.forget(key)
+            return None
+        return body, header
+
+    def set(self, key, body, header):
+        """
+        @type  header: dict
+        @param header: Content type and the like. The ETag is added.
+
+        @rtype:  dict
+        @return: Header of the entry, with its ETag.
+        """
+        header = dict(header, etag='"%s"' % hashlib.sha1(body).hexdigest()[:20])
+        data = json.dumps(header, sort_keys=True).encode('utf-8') + b'\n' + body
+        filename = self.filename(key)
+        temp = '%s.%d.%d' % (filename, os.getpid(), threading.current_thread().ident)
+        try:
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(temp, 'wb') as f:
+                f.write(data)
+            os.rename(temp, filename)
+        except (IOError, OSError) as e:
+            logging.warning('assets: cannot write %s: %s', filename, e)
+            return header
+        with self._lock:
+            old = self._index.pop(key, None)
+            if old is not None:
+                self.size -= old[0]
+            self._index[key] = (len(data), header['etag'])
+            self.size += len(data)
+        self.evict()
+        return header
+
+    def forget(self, key):
+        with self._lock:
+            entry = self._index.pop(key, None)
+            if entry is not None:
+                self.size -= entry[0]
+
+    def evict(self):
+        while True:
+            with self._lock:
+                if self.size <= self.max_bytes or not self._index:
+                    return
+                key, entry = self._index.popitem(last=False)
+                self.size -= entry[0]
+            try:
+                os.remove(self.filename(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        return {'entries': len(self._index), 'bytes': self.size,
+                'hits': self.hits, 'misses': self.misses}
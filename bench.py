@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PigFly, Open Source Google Search Solution
+#    Copyright (C) 2014-2020 WENS FOOD GROUP (<http://www.wens.com.cn>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#    Authored by Shengli Hu <hushengli@gmail.com>
+__author__ = 'Shengli Hu'
+
+# Benchmark the page rewriting and parsing paths against a corpus of saved
+# Google pages, or the pages recorded by pigfly.py --cassette_mode=record:
+#
+#    python bench.py [--repeat N] page1.html [page2.html ...]
+#    python bench.py [--repeat N] recorded.jsonl.gz
+#
+# With --check, compare the markup of the streaming rewriter with that of the
+# soup path instead, on the given pages or on the built-in fixture:
+#
+#    python bench.py --check [page1.html ...]
+
+import re
+import sys
+import time
+
+from cassette import read_bodies
+from gosearch import RESULT_IDS, asset_url, filter_result, load_parser, parse_only
+from rewriter import ASSET_RULES, LINK_RULES, link_schemes, rewrite_page
+
+if sys.version_info[0] > 2:
+    from html.parser import HTMLParser
+    from urllib.parse import quote
+else:
+    from HTMLParser import HTMLParser
+    from urllib import quote
+
+# Lazy import of tracemalloc, only available on Python 3.4 and later.
+tracemalloc = None
+
+
+# Result page with every element the strip and keep rules are about: the
+# #mn rows, the #desktop-search child, scripts inside and outside the kept
+# table, redirect links and Google hosted images.
+FIXTURE = u'''<!doctype html><html><head>
+<meta http-equiv="content-type" content="text/html; charset=UTF-8"><title>q</title>
+<style>body{margin:0}  .g{color:red}</style><style>#res{padding:0}</style>
+<script>var a = "<table>";</script></head><body>
+<div id="gb"><a href="/intl/zh-CN/about.html">About</a><table><tr><td>not kept</td></tr></table></div>
+<table id="mn">
+<tr><td>row 1</td></tr><tr><td>row 2</td></tr><tr><td>row 3</td></tr>
+<tr><td id="leftnav">left<ul><li>web<li>images</ul></td>
+<td><div id="search"><ol id="rso">
+<li class="g"><h3 class="r"><a href="/url?q=http://example.com/a%3Fb%3D1&amp;sa=U&amp;ei=x">Example &amp; 中文</a></h3>
+<div class="s"><cite>example.com/a</cite><span class="st">Some   text
+ <b>bold</b> more</span></div>
+<img src="/images?q=tbn:abc" width=10><img src="data:image/gif;base64,R0lGOD=">
+<script>google.x()</script></li>
+<li class="g"><h3 class="r"><a href="/search?q=related">Related</a></h3>
+<a href="/url?q=javascript://example.com/%250aalert(1)&amp;sa=U">not a page</a>
+<img src="http://t0.gstatic.com/images?q=tbn:def" alt="x"></li>
+</ol></div><br/><script>google.y()</script></td>
+<td id="desktop-search"><table><tr><td>kept</td><td>dropped</td><td>kept too</td></tr></table></td>
+</tr></table>
+<div id="bfl">bottom</div><div id="fll">footer</div><script>google.z()</script>
+</body></html>'''
+
+
+# The original BeautifulSoup + prettify rewriting path, kept as reference.
+# Links and images are rewritten the way the streaming rewriter does.
+def soup_rewrite(html, link_filter=None, beacon=None, asset_filter=None):
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html)
+
+    for tag_name, name in LINK_RULES:
+        for tag in soup.find_all(tag_name) if link_filter else ():
+            link = tag.get(name)
+            if not link or not link.startswith('/url?'):
+                continue
+            target = link_filter(link if isinstance(link, str) else link.encode('utf-8'))
+            if not target:
+                continue
+            if not isinstance(target, type(u'')):
+                target = target.decode('utf-8', 'replace')
+            if not link_schemes.match(target):
+                continue
+            tag[name] = target
+            if beacon:
+                tag['ping'] = beacon % quote(target.encode('utf-8') if bytes is str else target, safe='')
+    for tag_name, name in ASSET_RULES:
+        for tag in soup.find_all(tag_name) if asset_filter else ():
+            local = tag.get(name) and asset_filter(tag[name])
+            if local:
+                tag[name] = local
+
+    # del top
+    soup.find(id='gb').decompose()
+    soup.find(id='mn').tr.decompose()
+    soup.find(id='mn').tr.decompose()
+    soup.find(id='mn').tr.decompose()
+
+    # del left
+    soup.find(id='leftnav').decompose()
+
+    # del right
+    soup.find(id='desktop-search').tr.contents[1].decompose()
+
+    # del bottom
+    soup.find(id='bfl').decompose()
+    soup.find(id='fll').decompose()
+
+    # del script: 'html body script'
+    for tag in soup.find_all('script'):
+        tag.decompose()
+
+    style1 = soup.style.extract().prettify(formatter="html")
+    style2 = soup.style.extract().prettify(formatter="html")
+    table = soup.table.extract().prettify(formatter="html")
+    return [style1, style2, table]
+
+
+# Markup as a list of tags and text, whatever its layout: whitespace is
+# collapsed and trimmed, entities and character references are decoded, and
+# attributes sorted, prettify() sorts them.
+class Tokens(HTMLParser):
+
+    def __init__(self):
+        if sys.version_info[0] > 2:
+            HTMLParser.__init__(self, convert_charrefs=True)
+        else:
+            HTMLParser.__init__(self)
+        self.tokens = list()
+        self.text = list()
+
+    def flush(self):
+        text = re.sub(r'\s+', u' ', u''.join(self.text)).strip()
+        if text:
+            self.tokens.append(('text', text))
+        self.text = list()
+
+    def handle_starttag(self, tag, attrs):
+        self.flush()
+        self.tokens.append(('start', tag, tuple(sorted(attrs))))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        self.flush()
+        self.tokens.append(('end', tag))
+
+    def handle_data(self, data):
+        self.text.append(data)
+
+    def handle_entityref(self, name):
+        self.text.append(self.unescape(u'&%s;' % name))
+
+    def handle_charref(self, name):
+        self.text.append(self.unescape(u'&#%s;' % name))
+
+
+def tokens(markup):
+    if isinstance(markup, bytes):
+        markup = markup.decode('utf-8')
+    parser = Tokens()
+    parser.feed(markup)
+    parser.close()
+    parser.flush()
+    return parser.tokens
+
+
+# Compare the streaming rewriter with the soup path on every page, with the
+# link and image rewriting of the pipeline. Returns the differences found.
+def check(pages):
+    options = dict(link_filter=filter_result, beacon='/click?q=%s',
+                   asset_filter=lambda src: asset_url(src, '/asset?u=%s'))
+    differences = list()
+    for n, html in enumerate(pages):
+        expected = soup_rewrite(html, **options)
+        actual = rewrite_page(html, **options)
+        for i, (a, b) in enumerate(zip(expected, actual)):
+            a, b = tokens(a), tokens(b)
+            if a == b:
+                continue
+            at = next((j for j, (x, y) in enumerate(zip(a, b)) if x != y), min(len(a), len(b)))
+            differences.append('page %d, element %d, token %d: %r != %r'
+                               % (n, i, at, a[at] if at < len(a) else None, b[at] if at < len(b) else None))
+    return differences
+
+
+# The full parse get_search_result() used to do, kept as reference.
+def full_parse(html):
+    return load_parser()(html)
+
+
+# The parse get_search_result() does now.
+def result_parse(html):
+    return parse_only(html, RESULT_IDS)
+
+
+# Run a rewriting path over every page and return (seconds per page, bytes out).
+def run(rewrite, pages, repeat):
+    size = 0
+    started = time.time()
+    for i in range(repeat):
+        for html in pages:
+            result = rewrite(html)
+            if not i:
+                size += sum(len(blob.encode('utf-8')) for blob in result)
+    elapsed = time.time() - started
+    return elapsed / (repeat * len(pages)), size
+
+
+# Largest peak of traced memory while parsing a single page, or None
+# without tracemalloc.
+def peak_memory(parse, pages):
+    global tracemalloc
+    if tracemalloc is None:
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = False
+    if not tracemalloc:
+        return None
+    peak = 0
+    for html in pages:
+        tracemalloc.start()
+        try:
+            soup = parse(html)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            del soup
+        finally:
+            tracemalloc.stop()
+    return peak
+
+
+if __name__ == "__main__":
+
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.set_usage("%prog [options] page.html|cassette.jsonl.gz [...]")
+    parser.add_option("--repeat", metavar="N", type="int", default=10,
+                      help="passes over the corpus [default: 10]")
+    parser.add_option("--check", action="store_true", default=False,
+                      help="compare the output of both rewriters instead")
+    (options, args) = parser.parse_args()
+    if not args and not options.check:
+        parser.print_help()
+        sys.exit(2)
+
+    pages = list()
+    for path in args:
+        if path.endswith('.gz'):
+            # Only result pages have the main table the rewriters look for.
+            pages.extend(html for html in read_bodies(path) if b'id="search"' in html)
+            continue
+        with open(path, 'rb') as f:
+            pages.append(f.read())
+    if options.check:
+        differences = check(pages or [FIXTURE.encode('utf-8')])
+        for difference in differences:
+            print(difference)
+        print('%d pages checked, %d differences' % (max(len(pages), 1), len(differences)))
+        sys.exit(1 if differences else 0)
+
+    size_in = sum(len(html) for html in pages)
+
+    print('%d pages, %d bytes in' % (len(pages), size_in))
+    for name, rewrite in (('soup+prettify', soup_rewrite),
+                          ('streaming', rewrite_page)):
+        per_page, size_out = run(rewrite, pages, options.repeat)
+        print('%-14s %8.2f ms/page %10d bytes out' % (name, per_page * 1000, size_out))
+    for name, parse in (('full parse', full_parse),
+                        ('strained', result_parse)):
+        started = time.time()
+        for i in range(options.repeat):
+            for html in pages:
+                parse(html)
+        per_page = (time.time() - started) / (options.repeat * len(pages))
+        peak = peak_memory(parse, pages)
+        peak = '%10d bytes peak' % peak if peak is not None else '  peak memory n/a'
+        print('%-14s %8.2f ms/page %s' % (name, per_page * 1000, peak))
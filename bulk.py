@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PigFly, Open Source Google Search Solution
+#    Copyright (C) 2014-2020 WENS FOOD GROUP (<http://www.wens.com.cn>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#    Authored by Shengli Hu <hushengli@gmail.com>
+__author__ = 'Shengli Hu'
+__all__ = ['read_query_list', 'done_queries', 'search_one', 'run']
+
+# Run a list of queries through get_search_result and write JSON lines:
+#
+#    python bulk.py [options] [queries.txt]
+#
+# Queries are read one per line, from stdin if no file is given. Every
+# finished query is appended to the output file at once, so an interrupted
+# job started again with the same output skips the queries already done.
+
+import io
+import json
+import logging
+import math
+import os
+import sys
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import gosearch
+
+from accesslog import read_records
+from cache import cache_key
+from gosearch import GROUPS
+from upstream import CircuitOpen, UpstreamBlocked, breaker, budget
+
+
+# Read the queries of a file, one per line, skipping blanks and repeats.
+def read_query_list(stream):
+    seen = set()
+    for line in stream:
+        query = u' '.join(line.split())
+        key = cache_key(query)
+        if query and key not in seen:
+            seen.add(key)
+            yield query
+
+
+# Keys of the queries an earlier run already wrote out without error.
+def done_queries(path):
+    done = set()
+    if path and os.path.exists(path):
+        for record in read_records(path):
+            if 'query' in record and 'error' not in record:
+                done.add(cache_key(record['query']))
+    return done
+
+
+# Search one query, waiting for the shared budget and the circuit breaker.
+def search_one(query, params, retries=2):
+    """
+    @type  query: unicode
+    @param query: Query to search.
+
+    @type  params: dict
+    @param params: Keyword arguments for L{gosearch.get_search_result}.
+
+    @type  retries: int
+    @param retries: Further attempts when Google blocks us or is suspended.
+
+    @rtype:  dict
+    @return: Record with the query, the seconds it took and either the
+        result groups or the error.
+    """
+    pages = max(1, int(math.ceil((params['stop'] - params['start']) / float(params['num']))))
+    started = time.time()
+    for attempt in range(retries + 1):
+        budget.wait(1 + pages)
+        try:
+            result = gosearch.get_search_result(query.encode('utf-8'), **params)
+        except (CircuitOpen, UpstreamBlocked) as e:
+            if attempt == retries:
+                error = e
+                break
+            time.sleep(breaker.retry_after() or 5)
+        except Exception as e:
+            error = e
+            break
+        else:
+            record = dict(zip(GROUPS, result))
+            record.update(query=query, s=round(time.time() - started, 3))
+            return record
+    return {'query': query, 's': round(time.time() - started, 3),
+            'error': '%s: %s' % (type(error).__name__, error)}
+
+
+# Search every query with a few workers and write the records as they finish.
+def run(queries, output, params, workers=4, done=()):
+    """
+    @type  queries: iterable of unicode
+    @param queries: Queries to search.
+
+    @type  output: file
+    @param output: Binary stream the JSON lines are written to.
+
+    @type  params: dict
+    @param params: Keyword arguments for L{gosearch.get_search_result}.
+
+    @type  workers: int
+    @param workers: Queries searched at the same time. They share the
+        cookie jar, the DNS cache, the rate budget and the circuit breaker.
+
+    @type  done: set
+    @param done: Cache keys of the queries to skip.
+
+    @rtype:  tuple
+    @return: Number of queries written, and of those that failed.
+    """
+    written = failed = 0
+    pending = set()
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    def drain(until):
+        count = errors = 0
+        while len(pending) > until:
+            finished, ignored = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                pending.discard(future)
+                record = future.result()
+                line = json.dumps(record, ensure_ascii=False, sort_keys=True)
+                output.write(line.encode('utf-8') + b'\n')
+                output.flush()
+                count += 1
+                errors += 'error' in record
+        return count, errors
+
+    try:
+        for query in queries:
+            if cache_key(query) in done:
+                continue
+            pending.add(executor.submit(search_one, query, params))
+            count, errors = drain(workers * 2)
+            written += count
+            failed += errors
+        count, errors = drain(0)
+        written += count
+        failed += errors
+    finally:
+        executor.shutdown(wait=False)
+    return written, failed
+
+
+if __name__ == "__main__":
+
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.set_usage("%prog [options] [queries.txt]")
+    parser.add_option("--tld", metavar="TLD", type="string", default="com",
+                      help="top level domain to use [default: com]")
+    parser.add_option("--lang", metavar="LANGUAGE", type="string", default="en",
+                      help="produce results in the given language [default: en]")
+    parser.add_option("--num", metavar="NUMBER", type="int", default=10,
+                      help="number of results per page [default: 10]")
+    parser.add_option("--stop", metavar="NUMBER", type="int", default=10,
+                      help="last result to retrieve [default: 10]")
+    parser.add_option("--workers", metavar="NUMBER", type="int", default=4,
+                      help="queries searched at the same time [default: 4]")
+    parser.add_option("--rate", metavar="NUMBER", type="float", default=1.0,
+                      help="requests per second sent to Google [default: 1.0]")
+    parser.add_option("--burst", metavar="NUMBER", type="int", default=10,
+                      help="requests sent to Google in a burst [default: 10]")
+    parser.add_option("--output", metavar="FILE", type="string", default=None,
+                      help="JSON lines file, appended to and resumed from [default: stdout]")
+    (options, args) = parser.parse_args()
+    if len(args) > 1:
+        parser.print_help()
+        sys.exit(2)
+    if options.stop <= 0:
+        parser.error('--stop must be positive, bulk searches cannot page forever')
+
+    logging.basicConfig(level=logging.INFO)
+    budget.rate = options.rate
+    budget.burst = budget.tokens = options.burst
+    params = dict(tld=options.tld, lang=options.lang, num=options.num,
+                  start=0, stop=options.stop, pause=0)
+
+    if args and args[0] != '-':
+        source = io.open(args[0], encoding='utf-8')
+    else:
+        source = io.open(sys.stdin.fileno(), encoding='utf-8', closefd=False)
+    if options.output:
+        output = open(options.output, 'ab')
+    else:
+        output = getattr(sys.stdout, 'buffer', sys.stdout)
+
+    started = time.time()
+    written, failed = run(read_query_list(source), output, params,
+                          workers=options.workers, done=done_queries(options.output))
+    logging.info('bulk: %d queries in %.1fs, %d failed', written, time.time() - started, failed)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PigFly, Open Source Google Search Solution
+#    Copyright (C) 2014-2020 WENS FOOD GROUP (<http://www.wens.com.cn>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#    Authored by Shengli Hu <hushengli@gmail.com>
+__author__ = 'Shengli Hu'
+__all__ = ['LRUCache', 'cache_key']
+
+import threading
+import time
+
+from collections import OrderedDict
+
+
+# Normalize the query so trivial variants share one cache entry.
+def cache_key(query):
+    """
+    Build the cache key for a search query.
+
+    @type  query: str
+    @param query: Query string as typed by the user.
+
+    @rtype:  str
+    @return: Query with case folded and whitespace collapsed.
+    """
+    return ' '.join(query.split()).lower()
+
+
+class LRUCache(object):
+    """
+    Least recently used cache with an optional time to live.
+
+    Safe to share between the IOLoop thread and background workers.
+    """
+
+    def __init__(self, capacity=1024, ttl=None):
+        """
+        @type  capacity: int
+        @param capacity: Maximum number of entries kept.
+
+        @type  ttl: float
+        @param ttl: Seconds an entry stays valid. Use C{None} to never expire.
+        """
+        self.capacity = capacity
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                return default
+            del self._data[key]
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl:
+            expires = time.time() + self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+
+    def get_stale(self, key, default=None):
+        """
+        Like L{get}, but expired entries are returned too, as long as they
+        have not been evicted yet.
+        """
+        with self._lock:
+            try:
+                return self._data[key][1]
+            except KeyError:
+                return default
+
+    def values(self):
+        """
+        @rtype:  list
+        @return: Every cached value, expired or not, without refreshing them.
+        """
+        with self._lock:
+            return [value for expires, value in self._data.values()]
+
+    def expires(self, key):
+        """
+        @rtype:  float
+        @return: Time the entry expires at, without refreshing its recency.
+            C{None} if the key is not cached or never expires.
+        """
+        with self._lock:
+            try:
+                return self._data[key][0]
+            except KeyError:
+                return None
+
+    def snapshot(self, limit=None):
+        """
+        @type  limit: int
+        @param limit: Keep only this many of the most recently used entries.
+
+        @rtype:  list of tuple
+        @return: Entries as (key, expires, value), least recently used first,
+            expired ones included.
+        """
+        with self._lock:
+            items = [(key, expires, value) for key, (expires, value) in self._data.items()]
+        if limit is not None:
+            items = items[-limit:] if limit else []
+        return items
+
+    def restore(self, items):
+        """
+        Add entries returned by L{snapshot}, keeping their expiry times and
+        their order, without pushing out more recent entries.
+        """
+        with self._lock:
+            # Entries already cached are more recent than the snapshot.
+            data = OrderedDict((key, (expires, value)) for key, expires, value in items
+                               if key not in self._data)
+            data.update(self._data)
+            self._data = data
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                return self._data.pop(key)[1]
+            except KeyError:
+                return default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PigFly, Open Source Google Search Solution
+#    Copyright (C) 2014-2020 WENS FOOD GROUP (<http://www.wens.com.cn>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#    Authored by Shengli Hu <hushengli@gmail.com>
+__author__ = 'Shengli Hu'
+__all__ = ['Cassette', 'Reply', 'NotRecorded', 'read_bodies']
+
+import base64
+import codecs
+import gzip
+import json
+import re
+import socket
+import sys
+import threading
+import time
+
+from collections import defaultdict, deque
+
+from upstream import UpstreamTimeout
+
+if sys.version_info[0] > 2:
+    from http.client import parse_headers
+    from io import BytesIO
+    from urllib.error import HTTPError, URLError
+else:
+    from httplib import HTTPMessage
+    from StringIO import StringIO
+    from urllib2 import HTTPError, URLError
+
+# Charset parameter of a Content-Type header.
+content_charset = re.compile(r'charset\s*=\s*["\']?([\w.:-]+)', re.I)
+
+# Modes of a cassette.
+RECORD = 'record'
+REPLAY = 'replay'
+
+
+class NotRecorded(URLError):
+    """
+    A request missing from the cassette being replayed. Google never saw
+    it, so it says nothing about the upstream.
+    """
+
+
+# Headers of a response as text, the way they came on the wire.
+def header_text(headers):
+    if headers is None:
+        return ''
+    if hasattr(headers, 'headers'):
+        # Python 2 keeps the raw header lines.
+        return ''.join(headers.headers)
+    return ''.join('%s: %s\r\n' % item for item in headers.items())
+
+
+# Parse headers saved by header_text() back into a message object.
+def parse_header_text(text):
+    if sys.version_info[0] > 2:
+        return parse_headers(BytesIO(text.encode('latin-1') + b'\r\n'))
+    return HTTPMessage(StringIO(text.encode('latin-1') + '\r\n'))
+
+
+class Reply(object):
+    """
+    Response to a request to Google, read in full.
+
+    Has the C{info()} and C{geturl()} methods cookielib needs to extract
+    the cookies, whether it comes from the network or from a cassette.
+    """
+
+    def __init__(self, url, code, headers, body):
+        self.url = url
+        self.code = code
+        self.headers = headers
+        self.body = body
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    @property
+    def charset(self):
+        """
+        Charset declared by the Content-Type header, or C{None} if there
+        is none or Python does not know it.
+        """
+        m = self.headers is not None and content_charset.search(self.headers.get('Content-Type', ''))
+        if not m:
+            return None
+        try:
+            return codecs.lookup(m.group(1)).name
+        except LookupError:
+            return None
+
+
+class Cassette(object):
+    """
+    Record and replay of the requests sent to Google.
+
+    In record mode every request goes out as usual, and its URL, response
+    and duration, or the error it failed with, are appended to a gzipped
+    JSON lines file. In replay mode the network is never used: requests are
+    answered from the file, optionally taking as long as they did when they
+    were recorded. A URL recorded several times is answered with each of
+    its recordings in turn.
+    """
+
+    def __init__(self, path, mode=REPLAY, speed=1.0):
+        """
+        @type  path: str
+        @param path: Cassette file.
+
+        @type  mode: str
+        @param mode: C{'record'} or C{'replay'}.
+
+        @type  speed: float
+        @param speed: Share of the recorded latency reproduced on replay,
+            1.0 for the recorded latency and 0 to answer at once.
+        """
+        if mode not in (RECORD, REPLAY):
+            raise ValueError('unknown cassette mode: %s' % mode)
+        self.path = path
+        self.mode = mode
+        self.speed = speed
+        self.entries = defaultdict(deque)
+        self.recorded = 0
+        self.replayed = 0
+        self.missing = 0
+        self.stream = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        if self.mode == RECORD:
+            # Appending adds a gzip member, readers see one stream.
+            self.stream = gzip.open(self.path, 'ab')
+            return
+        with self._lock:
+            self.entries.clear()
+            for entry in read_entries(self.path):
+                self.entries[entry['url']].append(entry)
+
+    def close(self):
+        with self._lock:
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+
+    def fetch(self, request, url, deadline, limit, send):
+        """
+        Send a request through the cassette.
+
+        @type  send: callable
+        @param send: Sends the request over the network, see
+            L{gosearch.send_request}. Only called in record mode.
+
+        @rtype:  L{Reply}
+        @return: Response to the request.
+
+        @raise IOError: The request failed, for real or on the recording.
+
+        @raise NotRecorded: The request is not on the cassette being replayed.
+        """
+        if self.mode == RECORD:
+            return self.record(request, url, deadline, limit, send)
+        return self.replay(url, deadline)
+
+    def record(self, request, url, deadline, limit, send):
+        entry = {'url': url, 'ts': round(time.time(), 3)}
+        started = time.time()
+        try:
+            reply = send(request, url, deadline, limit)
+        except HTTPError as e:
+            entry.update(error='http', code=e.code, message=str(e.msg),
+                         headers=header_text(e.hdrs))
+            raise
+        except (socket.timeout, UpstreamTimeout) as e:
+            entry.update(error='timeout', message=str(e))
+            raise
+        except URLError as e:
+            if isinstance(e.reason, socket.timeout):
+                entry.update(error='timeout', message=str(e.reason))
+            else:
+                entry.update(error='url', message=str(e.reason))
+            raise
+        except Exception as e:
+            entry.update(error='io', message=str(e))
+            raise
+        else:
+            entry.update(code=reply.code, final=reply.url, headers=header_text(reply.headers),
+                         body=base64.b64encode(reply.body).decode('ascii'))
+            return reply
+        finally:
+            entry['ms'] = round((time.time() - started) * 1000, 1)
+            self.write(entry)
+
+    def write(self, entry):
+        line = json.dumps(entry, sort_keys=True).encode('utf-8') + b'\n'
+        with self._lock:
+            if self.stream is None:
+                return
+            self.stream.write(line)
+            # Keep what was recorded if the server is killed.
+            self.stream.flush()
+            self.recorded += 1
+
+    def replay(self, url, deadline=None):
+        with self._lock:
+            recordings = self.entries.get(url)
+            if not recordings:
+                self.missing += 1
+                raise NotRecorded('not in cassette: %s' % url)
+            entry = recordings[0]
+            recordings.rotate(-1)
+            self.replayed += 1
+
+        delay = entry['ms'] / 1000.0 * self.speed
+        if deadline is not None and time.time() + delay > deadline:
+            time.sleep(max(0, deadline - time.time()))
+            raise socket.timeout('timed out on replay')
+        time.sleep(delay)
+
+        headers = parse_header_text(entry.get('headers', ''))
+        error = entry.get('error')
+        if error == 'http':
+            raise HTTPError(url, entry['code'], entry['message'], headers, None)
+        if error == 'timeout':
+            raise socket.timeout(entry['message'])
+        if error is not None:
+            raise URLError(entry['message'])
+        return Reply(entry['final'], entry['code'], headers, base64.b64decode(entry['body']))
+
+    def stats(self):
+        return {'mode': self.mode, 'recorded': self.recorded, 'replayed': self.replayed,
+                'missing': self.missing, 'urls': len(self.entries)}
+
+
+# Read the entries of a cassette file, skipping a damaged tail.
+def read_entries(path):
+    with gzip.open(path, 'rb') as f:
+        while True:
+            try:
+                line = f.readline()
+            except (IOError, EOFError):
+                # The recording server was killed in the middle of a write.
+                break
+            if not line:
+                break
+            try:
+                yield json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+
+
+# Pages of the successful recordings of a cassette, for bench.py.
+def read_bodies(path):
+    for entry in read_entries(path):
+        if entry.get('body'):
+            yield base64.b64decode(entry['body'])
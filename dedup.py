@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PigFly, Open Source Google Search Solution
+#    Copyright (C) 2014-2020 WENS FOOD GROUP (<http://www.wens.com.cn>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#    Authored by Shengli Hu <hushengli@gmail.com>
+__author__ = 'Shengli Hu'
+__all__ = ['canonical_url', 'SetIndex', 'BloomFilter', 'seen_index']
+
+import hashlib
+import math
+import struct
+import sys
+
+if sys.version_info[0] > 2:
+    from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+else:
+    from urllib import urlencode
+    from urlparse import parse_qsl, urlparse, urlunparse
+
+# Ports left out of canonical URLs.
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# Query parameters that only track the visitor and never change the page.
+TRACKING_PARAMS = ('utm_source', 'utm_medium', 'utm_campaign', 'utm_term',
+                   'utm_content', 'gclid', 'fbclid')
+
+# Size of the Bloom filter used when a search may page forever.
+bloom_capacity = 1000000
+bloom_error_rate = 0.001
+
+
+# Reduce a result URL to the form its trivial variants share.
+def canonical_url(link):
+    """
+    @type  link: str
+    @param link: Absolute URL of a result.
+
+    @rtype:  str
+    @return: The URL with scheme and host lowercased, the default port,
+        the fragment and tracking parameters removed, the remaining
+        parameters sorted and an empty path turned into C{/}.
+    """
+    if bytes is str and not isinstance(link, bytes):
+        # Python 2 only urlencodes byte strings.
+        link = link.encode('utf-8')
+    try:
+        o = urlparse(link)
+        scheme = o.scheme.lower()
+        host = (o.hostname or '').rstrip('.')
+        port = o.port
+    except ValueError:
+        return link
+    netloc = '[%s]' % host if ':' in host else host
+    if port and port != DEFAULT_PORTS.get(scheme):
+        netloc = '%s:%d' % (netloc, port)
+    params = [(k, v) for k, v in parse_qsl(o.query, True)
+              if k.lower() not in TRACKING_PARAMS]
+    return urlunparse((scheme, netloc, o.path or '/', o.params,
+                       urlencode(sorted(params)), ''))
+
+
+class SetIndex(object):
+    """
+    Exact index of the URLs seen so far. Memory grows with every URL.
+    """
+
+    def __init__(self):
+        self.keys = set()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, link):
+        return canonical_url(link) in self.keys
+
+    def add(self, link):
+        """
+        @rtype:  bool
+        @return: C{True} if the URL was not seen before.
+        """
+        key = canonical_url(link)
+        if key in self.keys:
+            return False
+        self.keys.add(key)
+        return True
+
+
+class BloomFilter(object):
+    """
+    Fixed size index of the URLs seen so far.
+
+    Memory stays the same however many URLs are added. The price is that
+    an unseen URL is taken for a repeated one with probability
+    C{error_rate}, as long as no more than C{capacity} URLs were added.
+    """
+
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        """
+        @type  capacity: int
+        @param capacity: URLs the filter is sized for.
+
+        @type  error_rate: float
+        @param error_rate: Wanted false positive rate at full capacity.
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def positions(self, link):
+        key = canonical_url(link)
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        # Double hashing: the k positions are h1 + i * h2.
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, link):
+        for p in self.positions(link):
+            if not self.bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def add(self, link):
+        """
+        @rtype:  bool
+        @return: C{True} if the URL was not seen before, give or take the
+            false positives.
+        """
+        new = False
+        for p in self.positions(link):
+            mask = 1 << (p & 7)
+            if not self.bits[p >> 3] & mask:
+                self.bits[p >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+
+# The index a search uses unless it is given one.
+def seen_index(stop=None):
+    """
+    @type  stop: int
+    @param stop: Last result the search retrieves, C{None} if unbounded.
+
+    @return: A L{SetIndex} for bounded searches, which cannot grow far,
+        and a L{BloomFilter} for searches that may page forever.
+    """
+    if stop:
+        return SetIndex()
+    return BloomFilter(bloom_capacity, bloom_error_rate)
@@ -20,23 +20,55 @@
 __author__ = 'Shengli Hu'
 __all__ = ['search']
 
+import logging
 import os
+import re
+import socket
 import sys
+import threading
 import time
 
+from cassette import REPLAY, NotRecorded, Reply
+from dedup import seen_index
+from resolver import happy_connect, resolver
+from rewriter import rewrite_page, sniff_charset
+from upstream import CircuitOpen, UpstreamBlocked, UpstreamTimeout
+from upstream import breaker, budget, latency
+
 if sys.version_info[0] > 2:
+    from http.client import HTTPConnection
     from http.cookiejar import LWPCookieJar
-    from urllib.request import Request, urlopen
-    from urllib.parse import quote_plus, urlparse, parse_qs
+    from urllib.error import HTTPError, URLError
+    from urllib.request import HTTPHandler, HTTPRedirectHandler, Request, build_opener
+    from urllib.parse import quote_plus, urljoin, urlparse, parse_qs
 else:
     from cookielib import LWPCookieJar
+    from httplib import HTTPConnection
     from urllib import quote_plus
-    from urllib2 import Request, urlopen
-    from urlparse import urlparse, parse_qs
+    from urllib2 import HTTPError, HTTPHandler, HTTPRedirectHandler, Request, URLError, build_opener
+    from urlparse import urljoin, urlparse, parse_qs
 
 # Lazy import of BeautifulSoup.
 BeautifulSoup = None
 
+# Lazily created thread pool for hedged requests.
+hedge_executor = None
+
+# Seconds allowed to connect to Google, and to wait for each read.
+connect_timeout = 5.0
+read_timeout = 15.0
+
+# Records or replays the requests sent to Google, see L{cassette.Cassette}.
+# Requests go to the network as usual if not set.
+cassette = None
+
+# Tokens a hedged request leaves in the upstream budget.
+hedge_reserve = 5
+
+# Signs that Google answered with a block page instead of results.
+block_statuses = (429, 503)
+block_markers = (b'/sorry/index', b'id="captcha"', b'unusual traffic from your computer network')
+
 # URL templates to make Google searches.
 url_home = "http://www.google.%(tld)s/"
 url_search = "http://www.google.%(tld)s/search?hl=%(lang)s&q=%(query)s&btnG=Google+Search&tbs=%(tbs)s&safe=%(safe)s"
@@ -44,6 +76,15 @@ url_next_page = "http://www.google.%(tld)s/search?hl=%(lang)s&q=%(query)s&start=
 url_search_num = "http://www.google.%(tld)s/search?hl=%(lang)s&q=%(query)s&num=%(num)d&btnG=Google+Search&tbs=%(tbs)s&safe=%(safe)s"
 url_next_page_num = "http://www.google.%(tld)s/search?hl=%(lang)s&q=%(query)s&num=%(num)d&start=%(start)d&tbs=%(tbs)s&safe=%(safe)s"
 
+# Hosts only serving images, and the image paths of Google's own hosts.
+# Only these are fetched by the /asset handler.
+asset_hosts = re.compile(r'(^|\.)(gstatic\.com|googleusercontent\.com|ggpht\.com)$')
+google_hosts = re.compile(r'(^|\.)google(\.com?)?\.[a-z]{2,3}$')
+google_asset_paths = re.compile(r'^/(images([/?]|$)|logos/)')
+
+# Largest image fetched for the /asset handler.
+asset_max_bytes = 2 * 1024 * 1024
+
 # Cookie jar. Stored at the user's home folder.
 home_folder = os.getenv('HOME')
 if not home_folder:
@@ -56,32 +97,333 @@ try:
 except Exception:
     pass
 
+# Background workers fetch pages too, keep them from saving the jar at once.
+cookie_lock = threading.Lock()
+
+class TimedHTTPConnection(HTTPConnection):
+    """
+    HTTP connection with separate connect and read timeouts, connecting
+    through the shared DNS cache.
+    """
+
+    def __init__(self, host, connect_timeout=None, read_timeout=None, **kwargs):
+        HTTPConnection.__init__(self, host, **kwargs)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    def connect(self):
+        # Resolve through the DNS cache and race the addresses it returns.
+        addrs = resolver.resolve(self.host, self.port)
+        try:
+            self.sock = happy_connect(addrs, self.connect_timeout)
+        except socket.error:
+            resolver.invalidate(self.host, self.port)
+            raise
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(self.read_timeout)
+
+
+class TimedHTTPHandler(HTTPHandler):
+    """
+    Opens requests on a L{TimedHTTPConnection}, with the timeouts set on
+    the request by L{fetch_page}.
+    """
+
+    def http_open(self, req):
+        # Requests not made by fetch_page only have the timeout of urlopen.
+        connect = getattr(req, 'connect_timeout', req.timeout)
+        read = getattr(req, 'read_timeout', req.timeout)
+
+        def connection(host, **kwargs):
+            return TimedHTTPConnection(host, connect, read, **kwargs)
+        return self.do_open(connection, req)
+
+
+class TimedRedirectHandler(HTTPRedirectHandler):
+    """
+    Follows redirects with the timeouts of the request redirected, e.g. from
+    www.google.com to a country domain. Image requests are not followed
+    away from Google's images.
+    """
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        # Images are only followed to other images, see L{fetch_asset}.
+        if getattr(req, 'asset', False) and not is_asset(newurl):
+            raise HTTPError(newurl, code, 'redirected away from Google images', headers, fp)
+        new = HTTPRedirectHandler.redirect_request(self, req, fp, code, msg, headers, newurl)
+        if new is not None:
+            for name in ('connect_timeout', 'read_timeout', 'asset'):
+                if hasattr(req, name):
+                    setattr(new, name, getattr(req, name))
+        return new
+
+opener = build_opener(TimedHTTPHandler, TimedRedirectHandler)
+
 # Request the given URL and return the response page, using the cookie jar.
-def get_page(url):
+def get_page(url, deadline=None, hedge=False):
     """
     Request the given URL and return the response page, using the cookie jar.
 
     @type  url: str
     @param url: URL to retrieve.
 
+    @type  deadline: float
+    @param deadline: Time by which the page must be retrieved, as given by
+        C{time.time()}. Use C{None} for the connect and read timeouts only.
+
+    @type  hedge: bool
+    @param hedge: If C{True}, send a second request when the first one is
+        slower than 95% of the recent ones, and take whichever answers first.
+
     @rtype:  str
     @return: Web page retrieved for the given URL.
 
     @raise IOError: An exception is raised on error.
     @raise urllib2.URLError: An exception is raised on error.
     @raise urllib2.HTTPError: An exception is raised on error.
+    @raise UpstreamTimeout: Google did not answer in time.
+    """
+    return get_reply(url, deadline, hedge).body
+
+# Request the given URL and return the whole response, see L{get_page}.
+def get_reply(url, deadline=None, hedge=False):
+    """
+    @rtype:  L{cassette.Reply}
+    @return: Response to the request, with the charset it declares.
     """
+    if hedge:
+        return hedged_fetch(url, deadline)
+    return fetch_page(url, deadline)
+
+# Send a single request for the given URL.
+def fetch_page(url, deadline=None):
+    connect, read = connect_timeout, read_timeout
+    if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise UpstreamTimeout('deadline exceeded before requesting %s' % url)
+        connect = min(connect, remaining)
+        read = min(read, remaining)
+
+    # Leave Google alone while it is blocking us.
+    if not breaker.allow():
+        raise CircuitOpen('upstream suspended for %.0fs' % breaker.retry_after())
+
     request = Request(url)
     request.add_header('User-Agent',
                        'Mozilla/4.0 (compatible; MSIE 8.0; Windows NT 6.0)')
+    request.connect_timeout = connect
+    request.read_timeout = read
     cookie_jar.add_cookie_header(request)
 
-    response = urlopen(request)
-    cookie_jar.extract_cookies(response, request)
-    html = response.read()
-    response.close()
-    cookie_jar.save()
-    return html
+    # Every request to Google counts against the shared rate budget.
+    budget.spend()
+    started = time.time()
+    try:
+        reply = read_page(request, url, deadline)
+    except NotRecorded:
+        # A gap in the cassette, not a failure of Google.
+        raise
+    except Exception:
+        breaker.record_failure()
+        raise
+    breaker.record_success()
+    latency.add(time.time() - started)
+    # Cookies replayed from a cassette are not ours to keep.
+    if not replaying():
+        with cookie_lock:
+            cookie_jar.save()
+    return reply
+
+# Read the response to a request, turning timeouts and block pages into
+# UpstreamTimeout and UpstreamBlocked errors.
+def read_page(request, url, deadline=None):
+    try:
+        reply = transfer(request, url, deadline)
+    except socket.timeout as e:
+        raise UpstreamTimeout('%s: %s' % (url, e))
+    except HTTPError as e:
+        if e.code in block_statuses:
+            raise UpstreamBlocked('%s: HTTP %d' % (url, e.code))
+        raise
+    except URLError as e:
+        if isinstance(e.reason, socket.timeout):
+            raise UpstreamTimeout('%s: %s' % (url, e.reason))
+        raise
+    cookie_jar.extract_cookies(reply, request)
+    if '/sorry/' in reply.geturl():
+        raise UpstreamBlocked('%s: redirected to %s' % (url, reply.geturl()))
+    for marker in block_markers:
+        if marker in reply.body:
+            raise UpstreamBlocked('%s: block page' % url)
+    return reply
+
+# Whether requests are answered from a cassette instead of the network.
+def replaying():
+    return cassette is not None and cassette.mode == REPLAY
+
+# Send a request to Google, or have the cassette answer it if one is set.
+def transfer(request, url, deadline=None, limit=None):
+    if cassette is not None:
+        return cassette.fetch(request, url, deadline, limit, send_request)
+    return send_request(request, url, deadline, limit)
+
+# Send a request over the network and read the whole response.
+def send_request(request, url, deadline=None, limit=None):
+    """
+    @type  limit: int
+    @param limit: Largest body accepted. Use C{None} for no limit.
+
+    @rtype:  L{cassette.Reply}
+    @return: Response to the request.
+
+    @raise UpstreamTimeout: The deadline passed while reading the response.
+    @raise IOError: The body is larger than C{limit}.
+    """
+    response = opener.open(request, timeout=request.connect_timeout)
+    try:
+        # Read in chunks, so a slowly trickling page cannot outlive the deadline.
+        chunks = list()
+        size = 0
+        while True:
+            chunk = response.read(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+            if deadline is not None and time.time() > deadline:
+                raise UpstreamTimeout('deadline exceeded while reading %s' % url)
+            if limit is not None and size > limit:
+                raise IOError('%s: larger than %d bytes' % (url, limit))
+        return Reply(response.geturl(), response.getcode(), response.info(), b''.join(chunks))
+    finally:
+        response.close()
+
+# Request the given URL, and again on a second connection if the first
+# request is slow to answer. Returns the reply of whichever answers first.
+def hedged_fetch(url, deadline=None):
+
+    # Lazy import of the thread pool, only needed when hedging.
+    global hedge_executor
+    if hedge_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        hedge_executor = ThreadPoolExecutor(max_workers=8)
+    from concurrent.futures import FIRST_COMPLETED, wait
+
+    pending = [hedge_executor.submit(fetch_page, url, deadline)]
+    delay = latency.percentile(0.95)
+    if deadline is not None:
+        delay = min(delay, max(0, deadline - time.time()))
+    done, not_done = wait(pending, timeout=delay)
+    if not done and budget.allows(1, hedge_reserve):
+        pending.append(hedge_executor.submit(fetch_page, url, deadline))
+
+    # The slower request is left to finish on its own.
+    error = None
+    while pending:
+        done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+        pending = list(not_done)
+    raise error
+
+# Whether the URL is an image host of Google's, fetched by the /asset handler.
+def is_asset(url):
+    parts = urlparse(url)
+    if parts.scheme not in ('http', 'https'):
+        return False
+    host = parts.hostname or ''
+    if asset_hosts.search(host):
+        return True
+    path = parts.path + ('?' if parts.query else '')
+    return bool(google_hosts.search(host) and google_asset_paths.match(path))
+
+# Local URL an image of the results page is served from, if Google hosts it.
+def asset_url(src, template, tld='com'):
+    """
+    @type  src: str
+    @param src: Image URL as found in the page, possibly relative.
+
+    @type  template: str
+    @param template: Local URL with C{%s} standing for the quoted image URL.
+
+    @rtype:  str
+    @return: Local URL, or C{None} if the image is inline or not Google's.
+    """
+    if not isinstance(src, str):
+        src = src.encode('utf-8')
+    if src.startswith('data:'):
+        return None
+    url = urljoin(url_home % {'tld': tld}, src)
+    if not is_asset(url):
+        return None
+    return template % quote_plus(url)
+
+# Fetch an image of the results page, for the local asset cache.
+def fetch_asset(url, deadline=None):
+    """
+    Images do not count against the search budget and are fetched without
+    the cookies, so they never get the searches blocked.
+
+    @rtype:  tuple
+    @return: Body of the image and its content type.
+
+    @raise IOError: The URL is not an image Google hosts, it is too large,
+        or it could not be fetched in time.
+    """
+    if not is_asset(url):
+        raise IOError('not a Google asset: %s' % url)
+    connect, read = connect_timeout, read_timeout
+    if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise UpstreamTimeout('deadline exceeded before requesting %s' % url)
+        connect = min(connect, remaining)
+        read = min(read, remaining)
+    request = Request(url)
+    request.add_header('User-Agent',
+                       'Mozilla/4.0 (compatible; MSIE 8.0; Windows NT 6.0)')
+    request.connect_timeout = connect
+    request.read_timeout = read
+    request.asset = True
+    try:
+        reply = transfer(request, url, deadline, asset_max_bytes)
+    except socket.timeout as e:
+        raise UpstreamTimeout('%s: %s' % (url, e))
+    if not is_asset(reply.geturl()):
+        raise IOError('%s: redirected to %s' % (url, reply.geturl()))
+    content_type = reply.info().get('Content-Type', '')
+    if not content_type.startswith('image/'):
+        raise IOError('%s: not an image but %s' % (url, content_type))
+    return reply.body, content_type
+
+# Lazy import of BeautifulSoup.
+# Try to use BeautifulSoup 4 if available, fall back to 3 otherwise.
+def load_parser():
+    global BeautifulSoup
+    if BeautifulSoup is None:
+        try:
+            from bs4 import BeautifulSoup
+        except ImportError:
+            from BeautifulSoup import BeautifulSoup
+    return BeautifulSoup
+
+# Subtrees of the results page read by search() and get_search_result().
+SEARCH_IDS = ('search', 'nav')
+RESULT_IDS = ('search', 'topstuff', 'botstuff', 'nav')
+
+# Parse only the elements with the given ids and their contents. The rest
+# of the page is skipped by the parser instead of being built and dropped.
+# Pages already decoded to unicode skip the encoding detection of the parser.
+def parse_only(html, ids):
+    BeautifulSoup = load_parser()
+    if BeautifulSoup.__module__.startswith('bs4'):
+        from bs4 import SoupStrainer
+        return BeautifulSoup(html, parse_only=SoupStrainer(id=list(ids)))
+    from BeautifulSoup import SoupStrainer
+    return BeautifulSoup(html, parseOnlyThese=SoupStrainer(id=list(ids)))
 
 # Filter links found in the Google result pages HTML code.
 # Returns None if the link doesn't yield a valid result.
@@ -109,9 +451,226 @@ def filter_result(link):
         pass
     return None
 
+# Names of the groups returned by get_search_result, in order.
+GROUPS = ('main_items', 'news_leads', 'news_sects', 'norm_items',
+          'top_rel_kws', 'bot_rel_kws')
+
+# 按照先后顺序分为四组：
+# 1.main_items: 目标组
+# 2.news_leads: 头条组
+# 3.news_sects: 新闻区组
+# 4.norm_items: 一般组
+# 通用分为: top_rel_kws 头部相关搜索，bot_rel_kws 底部相关搜索
+# Each result is read from its own block, which may lack the cite or the
+# description: (block, title, cite, description) selectors, the last three
+# inside the block.
+cp_main_items = ('div#search div#ires ol#rso li.g div.rc', 'h3.r a',
+                 'div.s div div.f.kv._SWb cite._Rm', 'div.s div span.st')
+cp_news_leads = ('div#search div#ires ol#rso li#newsbox.g div._Hnc ol li._njd.scim div.nulead',
+                 'div span._Tyb a._Knc._R7c.l', 'div.gl', 'div.s span.st')
+cp_news_sects = ('div#search div#ires ol#rso li#newsbox.g div ol li._njd.card-section div.nusec',
+                 'div span._Tyb a._R7c.l', 'div.gl', None)
+cp_norm_items = ('div#search div#ires ol#rso div.srg li.g div.rc', 'h3.r a',
+                 'div.s div div.f.kv._SWb cite._Rm', 'div.s div span.st')
+cp_title_top_rel_kws = 'div#topstuff div#trev.std.card-section div a.nobr'
+cp_title_bot_rel_kws = 'div#botstuff div#brs div.card-section div.brs_col p._e4b a'
+
+# Outputs search_pipeline() can produce from one results page.
+OUTPUTS = ('page', 'records', 'links')
+
+# Build the URL of a Google results page.
+def results_url(query, tld='com', lang='en', tbs='0', safe='off', num=10, start=0):
+
+    # Prepare the search string.
+    query = quote_plus(query)
+
+    if start:
+        if num == 10:
+            url = url_next_page % vars()
+        else:
+            url = url_next_page_num % vars()
+    else:
+        if num == 10:
+            url = url_search % vars()
+        else:
+            url = url_search_num % vars()
+    return url
+
+# Grab the cookie from the home page, unless the jar already has one. A
+# cassette being replayed has no use for it, and seldom has the home page.
+def open_session(tld='com', deadline=None):
+    if replaying():
+        return False
+    domain = 'google.%s' % tld
+    for cookie in list(cookie_jar):
+        if cookie.domain.endswith(domain) and not cookie.is_expired():
+            return False
+    get_page(url_home % vars(), deadline)
+    return True
+
+# Collect the result links of a parsed results page.
+def extract_links(soup, only_standard=False, seen=None):
+    links = list()
+    anchors = soup.find(id='search').findAll('a')
+    for a in anchors:
+
+        # Leave only the "standard" results if requested.
+        # Otherwise grab all possible links.
+        if only_standard and (
+                    not a.parent or a.parent.name.lower() != "h3"):
+            continue
+
+        # Get the URL from the anchor tag.
+        try:
+            link = a['href']
+        except KeyError:
+            continue
+
+        # Filter invalid links and links pointing to Google itself.
+        link = filter_result(link)
+        if not link:
+            continue
+
+        # Discard repeated results.
+        if seen is not None and not seen.add(link):
+            continue
+
+        links.append(link)
+    return links
+
+# Text of the first element matching the selector inside a tag, or ''.
+def select_text(tag, selector):
+    found = tag.select(selector) if selector else None
+    return found[0].get_text() if found else u''
+
+# Collect the result groups of a parsed results page.
+def extract_records(soup, seen=None):
+    groups = [list() for name in GROUPS]
+    main_items, news_leads, news_sects, norm_items, top_rel_kws, bot_rel_kws = groups
+
+    # Skip results already seen, on this page or an earlier one.
+    def new_result(tag):
+        if seen is None:
+            return True
+        link = tag['href']
+        return seen.add(filter_result(link) or link)
+
+    # main items, news leads, news sects (no description) and norm items
+    for group, (block, title, dlink, desc) in ((main_items, cp_main_items), (news_leads, cp_news_leads),
+                                               (news_sects, cp_news_sects), (norm_items, cp_norm_items)):
+        for tag in soup.select(block):
+            found = tag.select(title)
+            if not found or not found[0].get('href') or not new_result(found[0]):
+                continue
+            group.append({'title': found[0].get_text(), 'link': found[0]['href'],
+                          'dlink': select_text(tag, dlink), 'desc': select_text(tag, desc)})
+
+    # rel keywords
+    for i in soup.select(cp_title_top_rel_kws):
+        top_rel_kws.append({'title': i.get_text(), 'link': i['href']})
+
+    for i in soup.select(cp_title_bot_rel_kws):
+        bot_rel_kws.append({'title': i.get_text(), 'link': i['href']})
+
+    return groups
+
+# Fetch one results page and run it through the requested output stages.
+def search_pipeline(query, outputs=OUTPUTS, tld='com', lang='en', tbs='0', safe='off',
+                    num=10, start=0, only_standard=False, beacon=None, timings=None,
+                    deadline=None, hedge=False, seen_links=None, seen_records=None,
+                    assets=None):
+    """
+    Search the given query string using Google, and turn the results page
+    into every output asked for. The page is fetched once and parsed at
+    most once, whatever the outputs.
+
+    @type  query: str
+    @param query: Query string. Must NOT be url-encoded.
+
+    @type  outputs: tuple
+    @param outputs: Outputs to produce, among L{OUTPUTS}:
+         - C{page}: the rewritten page as UTF-8 blobs, see L{rewrite_page}.
+         - C{records}: the result groups, see L{get_search_result}.
+         - C{links}: the result URLs, see L{search}.
+
+    @type  beacon: str
+    @param beacon: Click beacon of the rewritten page, see L{by_replace_page}.
+
+    @type  timings: dict
+    @param timings: If given, receives the seconds spent in each stage under
+        the keys C{home}, C{fetch}, C{rewrite} and C{parse}.
+
+    @type  deadline: float
+    @param deadline: Time by which every request to Google must be done, as
+        given by C{time.time()}. Use C{None} for no deadline.
+
+    @type  hedge: bool
+    @param hedge: Hedge the request for the results page, see L{get_page}.
+
+    @type  seen_links: L{dedup.SetIndex} or L{dedup.BloomFilter}
+    @param seen_links: Links to leave out of C{links}.
+
+    @type  seen_records: L{dedup.SetIndex} or L{dedup.BloomFilter}
+    @param seen_records: Results to leave out of C{records}.
+
+    @type  assets: str
+    @param assets: Local URL template the images of the rewritten page are
+        pointed at, see L{asset_url}. Use C{None} to keep Google's URLs.
+
+    The other parameters are those of L{search}.
+
+    @rtype:  dict
+    @return: Every output asked for by name. When C{records} or C{links}
+        is asked for, C{next} tells whether there is a next page.
+    """
+    if timings is None:
+        timings = dict()
+
+    started = time.time()
+    open_session(tld, deadline)
+    timings['home'] = time.time() - started
+
+    # Request the Google Search results page.
+    started = time.time()
+    reply = get_reply(results_url(query, tld, lang, tbs, safe, num, start), deadline, hedge)
+    timings['fetch'] = time.time() - started
+
+    # Decode the page once, with the charset Google declares, for both the
+    # rewriter and the parser.
+    html = reply.body.decode(reply.charset or sniff_charset(reply.body), 'replace')
+
+    views = dict()
+    if 'page' in outputs:
+        # Strip the page and keep its styles and main table, in one pass.
+        # Result links are pointed straight at their destinations on the way,
+        # and Google's images at the local asset cache.
+        asset_filter = None
+        if assets:
+            asset_filter = lambda src: asset_url(src, assets, tld)
+        started = time.time()
+        views['page'] = rewrite_page(html, link_filter=filter_result, beacon=beacon,
+                                     asset_filter=asset_filter, encoding='utf-8')
+        timings['rewrite'] = time.time() - started
+
+    if 'records' in outputs or 'links' in outputs:
+        started = time.time()
+        soup = parse_only(html, RESULT_IDS if 'records' in outputs else SEARCH_IDS)
+        if 'records' in outputs:
+            try:
+                views['records'] = extract_records(soup, seen_records)
+            except Exception as e:
+                # Google changed its markup, still serve the page.
+                logging.warning('records of %s: %s', query, e, exc_info=True)
+                views['records'] = [list() for name in GROUPS]
+        if 'links' in outputs:
+            views['links'] = extract_links(soup, only_standard, seen_links)
+        views['next'] = soup.find(id='nav') is not None
+        timings['parse'] = time.time() - started
+    return views
+
 # Returns a generator that yields URLs.
 def search(query, tld='com', lang='en', tbs='0', safe='off', num=10, start=0,
-           stop=None, pause=2.0, only_standard=False):
+           stop=None, pause=2.0, only_standard=False, seen=None):
     """
     Search the given query string using Google.
 
@@ -151,41 +710,20 @@ def search(query, tld='com', lang='en', tbs='0', safe='off', num=10, start=0,
         except for those that point back to Google itself. Defaults to C{False}
         for backwards compatibility with older versions of this module.
 
+    @type  seen: L{dedup.SetIndex} or L{dedup.BloomFilter}
+    @param seen: Index of the URLs already returned. Pass the same index to
+        several searches to skip results any of them returned. Created by
+        L{dedup.seen_index} if not given.
+
     @rtype:  generator
     @return: Generator (iterator) that yields found URLs. If the C{stop}
         parameter is C{None} the iterator will loop forever.
     """
 
-    # Lazy import of BeautifulSoup.
-    # Try to use BeautifulSoup 4 if available, fall back to 3 otherwise.
-    global BeautifulSoup
-    if BeautifulSoup is None:
-        try:
-            from bs4 import BeautifulSoup
-        except ImportError:
-            from BeautifulSoup import BeautifulSoup
-
-    # Set of hashes for the results found.
+    # Index of the results found.
     # This is used to avoid repeated results.
-    hashes = set()
-
-    # Prepare the search string.
-    query = quote_plus(query)
-
-    # Grab the cookie from the home page.
-    get_page(url_home % vars())
-
-    # Prepare the URL of the first request.
-    if start:
-        if num == 10:
-            url = url_next_page % vars()
-        else:
-            url = url_next_page_num % vars()
-    else:
-        if num == 10:
-            url = url_search % vars()
-        else:
-            url = url_search_num % vars()
+    if seen is None:
+        seen = seen_index(stop)
 
     # Loop until we reach the maximum result, if any (otherwise, loop forever).
     while not stop or start < stop:
@@ -193,56 +731,21 @@ def search(query, tld='com', lang='en', tbs='0', safe='off', num=10, start=0,
         # Sleep between requests.
         time.sleep(pause)
 
-        # Request the Google Search results page.
-        html = get_page(url)
-
-        # Parse the response and process every anchored URL.
-        soup = BeautifulSoup(html)
-        anchors = soup.find(id='search').findAll('a')
-        for a in anchors:
-
-            # Leave only the "standard" results if requested.
-            # Otherwise grab all possible links.
-            if only_standard and (
-                        not a.parent or a.parent.name.lower() != "h3"):
-                continue
-
-            # Get the URL from the anchor tag.
-            try:
-                link = a['href']
-            except KeyError:
-                continue
-
-            # Filter invalid links and links pointing to Google itself.
-            link = filter_result(link)
-            if not link:
-                continue
-
-            # Discard repeated results.
-            h = hash(link)
-            if h in hashes:
-                continue
-            hashes.add(h)
-
-            # Yield the result.
+        views = search_pipeline(query, ('links',), tld, lang, tbs, safe, num, start,
+                                only_standard=only_standard, seen_links=seen)
+        for link in views['links']:
             yield link
 
         # End if there are no more results.
-        if not soup.find(id='nav'):
+        if not views['next']:
             break
 
-        # Prepare the URL for the next request.
+        # Prepare the next request.
         start += num
-        if num == 10:
-            url = url_next_page % vars()
-        else:
-            url = url_next_page_num % vars()
-
 
-
-# Returns a generator that yields URLs.
+# Returns the result groups of the search.
 def get_search_result(query, tld='com', lang='en', tbs='0', safe='off', num=10, start=0,
-           stop=None, pause=2.0, only_standard=False):
+           stop=None, pause=2.0, only_standard=False, seen=None):
     """
     Search the given query string using Google.
 
@@ -282,70 +785,22 @@ def get_search_result(query, tld='com', lang='en', tbs='0', safe='off', num=10,
         except for those that point back to Google itself. Defaults to C{False}
         for backwards compatibility with older versions of this module.
 
-    @rtype:  generator
-    @return: Generator (iterator) that yields found URLs. If the C{stop}
-        parameter is C{None} the iterator will loop forever.
-    """
+    @type  seen: L{dedup.SetIndex} or L{dedup.BloomFilter}
+    @param seen: Index of the result links already returned. Pass the same
+        index to several searches to skip results any of them returned.
+        Created by L{dedup.seen_index} if not given.
 
-    # Lazy import of BeautifulSoup.
-    # Try to use BeautifulSoup 4 if available, fall back to 3 otherwise.
-    global BeautifulSoup
-    if BeautifulSoup is None:
-        try:
-            from bs4 import BeautifulSoup
-        except ImportError:
-            from BeautifulSoup import BeautifulSoup
+    @rtype:  list of list
+    @return: The result groups, named in L{GROUPS}. If the C{stop}
+        parameter is C{None} the search goes on until the last page.
+    """
 
-    # Set of hashes for the results found.
+    # Index of the results found.
     # This is used to avoid repeated results.
-    hashes = set()
-
-    # Prepare the search string.
-    query = quote_plus(query)
+    if seen is None:
+        seen = seen_index(stop)
 
-    # 按照先后顺序分为四组：
-    # 1.main_items: 目标组
-    # 2.news_leads: 头条组
-    # 3.news_sects: 新闻区组
-    # 4.norm_items: 一般组
-    # 通用分为: top_rel_kws 头部相关搜索，bot_rel_kws 底部相关搜索
-
-    main_items = list()
-    news_leads = list()
-    news_sects = list()
-    norm_items = list()
-    top_rel_kws = list()
-    bot_rel_kws = list()
-
-    cp_title_main_items = 'div#search div#ires ol#rso li.g div.rc h3.r a'
-    cp_dlink_main_items = 'div#search div#ires ol#rso li.g div.rc div.s div div.f.kv._SWb cite._Rm'
-    cp_desc_main_items = 'div#search div#ires ol#rso li.g div.rc div.s div span.st'
-    cp_title_news_leads = 'div#search div#ires ol#rso li#newsbox.g div._Hnc ol li._njd.scim div.nulead div span._Tyb a._Knc._R7c.l'
-    cp_dlink_news_leads = 'div#search div#ires ol#rso li#newsbox.g div._Hnc ol li._njd.scim div.nulead div.gl'
-    cp_desc_news_leads = 'div#search div#ires ol#rso li#newsbox.g div._Hnc ol li._njd.scim div.nulead div.s span.st'
-    cp_title_news_sects = 'div#search div#ires ol#rso li#newsbox.g div ol li._njd.card-section div.nusec div span._Tyb a._R7c.l'
-    cp_dlink_news_sects = 'div#search div#ires ol#rso li#newsbox.g div ol li._njd.card-section div.nusec div.gl'
-    cp_title_norm_items = 'div#search div#ires ol#rso div.srg li.g div.rc h3.r a'
-    cp_dlink_norm_items = 'div#search div#ires ol#rso div.srg li.g div.rc div.s div div.f.kv._SWb cite._Rm'
-    cp_desc_norm_items = 'div#search div#ires ol#rso div.srg li.g div.rc div.s div span.st'
-    cp_title_top_rel_kws = 'div#topstuff div#trev.std.card-section div a.nobr'
-    cp_title_bot_rel_kws = 'div#botstuff div#brs div.card-section div.brs_col p._e4b a'
-
-
-    # Grab the cookie from the home page.
-    get_page(url_home % vars())
-
-    # Prepare the URL of the first request.
-    if start:
-        if num == 10:
-            url = url_next_page % vars()
-        else:
-            url = url_next_page_num % vars()
-    else:
-        if num == 10:
-            url = url_search % vars()
-        else:
-            url = url_search_num % vars()
+    groups = [list() for name in GROUPS]
 
     # Loop until we reach the maximum result, if any (otherwise, loop forever).
     while not stop or start < stop:
@@ -353,86 +808,24 @@ def get_search_result(query, tld='com', lang='en', tbs='0', safe='off', num=10,
         # Sleep between requests.
         time.sleep(pause)
 
-        # Request the Google Search results page.
-        html = get_page(url)
-
-        # Parse the response and process every anchored URL.
-        soup = BeautifulSoup(html)
-
-        # main items
-        tag_title = soup.select(cp_title_main_items)
-        tag_dlink = soup.select(cp_dlink_main_items)
-        tag_desc = soup.select(cp_desc_main_items)
-
-        z = 0
-        for i in tag_title:
-            main_items.append({'title': i.get_text(), 'link': i['href'], 'dlink': tag_dlink[z].get_text(),
-                               'desc': tag_desc[z].get_text()})
-            z += 1
-
-        # news leads
-        tag_title = soup.select(cp_title_news_leads)
-        tag_dlink = soup.select(cp_dlink_news_leads)
-        tag_desc = soup.select(cp_desc_news_leads)
-
-        z = 0
-        for i in tag_title:
-            news_leads.append({'title': i.get_text(), 'link': i['href'], 'dlink': tag_dlink[z].get_text(),
-                               'desc': tag_desc[z].get_text()})
-            z += 1
-
-        # news sects  -- no description
-        tag_title = soup.select(cp_title_news_sects)
-        tag_dlink = soup.select(cp_dlink_news_sects)
-
-        z = 0
-        for i in tag_title:
-            news_sects.append({'title': i.get_text(), 'link': i['href'], 'dlink': tag_dlink[z].get_text(),
-                               'desc': ''})
-            z += 1
-
-        # norm items
-        tag_title = soup.select(cp_title_norm_items)
-        tag_dlink = soup.select(cp_dlink_norm_items)
-        tag_desc = soup.select(cp_desc_norm_items)
-
-        z = 0
-        for i in tag_title:
-            norm_items.append({'title': i.get_text(), 'link': i['href'], 'dlink': tag_dlink[z].get_text(),
-                               'desc': tag_desc[z].get_text()})
-            z += 1
-
-        # rel keywords
-        tag_top = soup.select(cp_title_top_rel_kws)
-
-        z = 0
-        for i in tag_top:
-            top_rel_kws.append({'title': i.get_text(), 'link': i['href']})
-            z += 1
-
-        tag_bot = soup.select(cp_title_bot_rel_kws)
-
-        z = 0
-        for i in tag_bot:
-            bot_rel_kws.append({'title': i.get_text(), 'link': i['href']})
-            z += 1
-
+        views = search_pipeline(query, ('records',), tld, lang, tbs, safe, num, start,
+                                seen_records=seen)
+        for group, records in zip(groups, views['records']):
+            group.extend(records)
 
         # End if there are no more results.
-        if not soup.find(id='nav'):
+        if not views['next']:
             break
 
-        # Prepare the URL for the next request.
+        # Prepare the next request.
         start += num
-        if num == 10:
-            url = url_next_page % vars()
-        else:
-            url = url_next_page_num % vars()
 
-    return [main_items, news_leads, news_sects, norm_items, top_rel_kws, bot_rel_kws]
+    return groups
 
+# Returns the rewritten results page.
 def by_replace_page(query, tld='com', lang='en', tbs='0', safe='off', num=10, start=0,
-           stop=None, pause=2.0, only_standard=False):
+           stop=None, pause=2.0, only_standard=False, beacon=None, timings=None,
+           deadline=None, hedge=False):
     """
     Search the given query string using Google.
 
@@ -472,78 +865,31 @@ def by_replace_page(query, tld='com', lang='en', tbs='0', safe='off', num=10, st
         except for those that point back to Google itself. Defaults to C{False}
         for backwards compatibility with older versions of this module.
 
-    @rtype:  generator
-    @return: Generator (iterator) that yields found URLs. If the C{stop}
-        parameter is C{None} the iterator will loop forever.
-    """
+    @type  beacon: str
+    @param beacon: URL template pinged when a result link is clicked, with
+        C{%s} standing for the quoted destination. Use C{None} for no beacon.
 
-    # Lazy import of BeautifulSoup.
-    # Try to use BeautifulSoup 4 if available, fall back to 3 otherwise.
-    global BeautifulSoup
-    if BeautifulSoup is None:
-        try:
-            from bs4 import BeautifulSoup
-        except ImportError:
-            from BeautifulSoup import BeautifulSoup
+    @type  timings: dict
+    @param timings: If given, receives the seconds spent in each stage, see
+        L{search_pipeline}.
 
-    # Set of hashes for the results found.
-    # This is used to avoid repeated results.
-    hashes = set()
+    @type  deadline: float
+    @param deadline: Time by which every request to Google must be done, as
+        given by C{time.time()}. Use C{None} for no deadline.
 
-    # Prepare the search string.
-    query = quote_plus(query)
-
-    # Grab the cookie from the home page.
-    get_page(url_home % vars())
-
-    # Prepare the URL of the first request.
-    if start:
-        if num == 10:
-            url = url_next_page % vars()
-        else:
-            url = url_next_page_num % vars()
-    else:
-        if num == 10:
-            url = url_search % vars()
-        else:
-            url = url_search_num % vars()
+    @type  hedge: bool
+    @param hedge: Hedge the request for the results page, see L{get_page}.
 
+    @rtype:  list of unicode
+    @return: The styles and main table of the page, see L{rewrite_page}.
+    """
 
     # Sleep between requests.
     time.sleep(pause)
 
-    # Request the Google Search results page.
-    html = get_page(url)
-
-    # Parse the response and process every anchored URL.
-    soup = BeautifulSoup(html)
-
-    # del top
-    soup.find(id='gb').decompose()
-    soup.find(id='mn').tr.decompose()
-    soup.find(id='mn').tr.decompose()
-    soup.find(id='mn').tr.decompose()    
-
-    # del left
-    soup.find(id='leftnav').decompose()
-
-    # del right
-    soup.find(id='desktop-search').tr.contents[1].decompose()
-
-
-    # del bottom
-    soup.find(id='bfl').decompose()
-    soup.find(id='fll').decompose()
-
-    # del script: 'html body script'
-    for tag in soup.find_all('script'):
-        tag.decompose()
-
-    style1 = soup.style.extract().prettify(formatter="html")
-    style2 = soup.style.extract().prettify(formatter="html")
-    table = soup.table.extract().prettify(formatter="html")
-    return [style1, style2, table]
-
+    views = search_pipeline(query, ('page',), tld, lang, tbs, safe, num, start,
+                            beacon=beacon, timings=timings, deadline=deadline, hedge=hedge)
+    return views['page']
 
 
 # When run as a script...
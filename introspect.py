@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PigFly, Open Source Google Search Solution
+#    Copyright (C) 2014-2020 WENS FOOD GROUP (<http://www.wens.com.cn>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#    Authored by Shengli Hu <hushengli@gmail.com>
+__author__ = 'Shengli Hu'
+__all__ = ['sample_stacks', 'allocations', 'object_counts']
+
+import gc
+import os
+import sys
+import threading
+import time
+
+from collections import defaultdict
+
+# Lazy import of tracemalloc, only available on Python 3.4 and later.
+tracemalloc = None
+
+# Only one profile runs at a time.
+profile_lock = threading.Lock()
+
+
+# Name a frame the way flamegraph tools expect it.
+def frame_name(frame):
+    code = frame.f_code
+    return '%s:%s' % (os.path.basename(code.co_filename), code.co_name)
+
+
+# Sample the stacks of every thread of this process.
+def sample_stacks(duration=10.0, interval=0.005):
+    """
+    Sampling CPU profile of the running process.
+
+    Every C{interval} seconds the stack of each thread is recorded. The
+    sampling thread itself is left out.
+
+    @type  duration: float
+    @param duration: Seconds to sample for.
+
+    @type  interval: float
+    @param interval: Seconds between two samples.
+
+    @rtype:  list of str
+    @return: Folded stacks, one "thread;outer;...;inner count" line per
+        distinct stack, as read by flamegraph.pl and speedscope.
+
+    @raise RuntimeError: Another profile is already running.
+    """
+    if not profile_lock.acquire(False):
+        raise RuntimeError('a profile is already running')
+    try:
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        me = threading.current_thread().ident
+        counts = defaultdict(int)
+        deadline = time.time() + duration
+        while time.time() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = list()
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'thread-%d' % ident))
+                stack.reverse()
+                counts[';'.join(stack)] += 1
+            time.sleep(interval)
+    finally:
+        profile_lock.release()
+    return ['%s %d' % item for item in sorted(counts.items())]
+
+
+# Top allocation sites, if tracemalloc is tracing.
+def allocations(limit=20, start=None):
+    """
+    @type  limit: int
+    @param limit: Number of allocation sites returned.
+
+    @type  start: bool
+    @param start: C{True} to start tracing, C{False} to stop it, C{None}
+        to leave it as it is.
+
+    @rtype:  dict
+    @return: Whether tracing is on, and the top allocation sites by size.
+    """
+    global tracemalloc
+    if tracemalloc is None:
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = False
+    if not tracemalloc:
+        return {'available': False}
+    if start is True and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif start is False and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    if not tracemalloc.is_tracing():
+        return {'available': True, 'tracing': False}
+    current, peak = tracemalloc.get_traced_memory()
+    top = list()
+    for stat in tracemalloc.take_snapshot().statistics('lineno')[:limit]:
+        frame = stat.traceback[0]
+        top.append({'where': '%s:%d' % (frame.filename, frame.lineno),
+                    'bytes': stat.size, 'count': stat.count})
+    return {'available': True, 'tracing': True, 'current': current,
+            'peak': peak, 'top': top}
+
+
+# Live objects by type, most common first.
+def object_counts(limit=20):
+    counts = defaultdict(int)
+    for obj in gc.get_objects():
+        counts[type(obj).__name__] += 1
+    return sorted(counts.items(), key=lambda x: x[1], reverse=True)[:limit]
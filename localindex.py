@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PigFly, Open Source Google Search Solution
+#    Copyright (C) 2014-2020 WENS FOOD GROUP (<http://www.wens.com.cn>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#    Authored by Shengli Hu <hushengli@gmail.com>
+__author__ = 'Shengli Hu'
+__all__ = ['LocalIndex', 'tokenize']
+
+import fcntl
+import gzip
+import json
+import logging
+import math
+import os
+import re
+import threading
+import zlib
+
+from array import array
+from collections import OrderedDict, defaultdict
+
+from dedup import canonical_url
+from rewriter import follow_link
+
+# Runs of CJK ideographs, kana and hangul, and runs of other word characters.
+CJK = u'\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+token_runs = re.compile(u'([%s]+)|([^\\W%s]+)' % (CJK, CJK), re.UNICODE)
+
+# Record groups holding results, see L{gosearch.GROUPS}.
+RESULT_GROUPS = (0, 1, 2, 3)
+
+# Title words count for this many words of the snippet.
+TITLE_WEIGHT = 3
+
+# BM25 parameters.
+K1 = 1.2
+B = 0.75
+
+
+# Split text into index terms.
+def tokenize(text, unigrams=False):
+    """
+    Words are split on anything that is not a word character. Runs of CJK
+    characters have no spaces between words, they are cut into overlapping
+    pairs of characters, so any word of two characters or more is found
+    without a dictionary.
+
+    @type  text: unicode
+    @param text: Text to split.
+
+    @type  unigrams: bool
+    @param unigrams: Add each CJK character as a term too, so queries of a
+        single character find the text.
+
+    @rtype:  list of unicode
+    @return: Terms, lowercased, in the order of the text.
+    """
+    terms = list()
+    for cjk, word in token_runs.findall(text.lower()):
+        if word:
+            terms.append(word)
+        elif len(cjk) == 1:
+            terms.append(cjk)
+        else:
+            terms.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+            if unigrams:
+                terms.extend(cjk)
+    return terms
+
+
+class LocalIndex(object):
+    """
+    Inverted index of the results Google returned, searched when Google
+    cannot be.
+
+    Results are keyed by their canonical URL, and every query seen keeps
+    the order Google gave its results in, so an exact repeat is answered as
+    Google answered it. Other queries are ranked with BM25 over the titles
+    and snippets. Postings are arrays of document numbers, one entry per
+    occurrence. Documents pushed out by the size cap are only dropped from
+    the postings when the arrays are rebuilt, once half of them are dead.
+
+    On disk the index is a gzipped JSON lines journal of the results and
+    queries added, replayed at startup and rewritten once it holds twice
+    as many lines as the live index. Only one worker writes it, the one
+    holding the lock file next to it: a worker started next to the old one
+    during a restart keeps its index in memory until the old one exits,
+    then takes the lock and rewrites the journal with its whole index.
+    """
+
+    def __init__(self, path=None, capacity=50000, link_filter=None):
+        """
+        @type  path: str
+        @param path: Journal file. Use C{None} to keep the index in memory.
+
+        @type  capacity: int
+        @param capacity: Results kept, and queries remembered.
+
+        @type  link_filter: callable
+        @param link_filter: Decodes Google redirect links, see
+            L{gosearch.filter_result}.
+        """
+        self.path = path
+        self.capacity = capacity
+        self.link_filter = link_filter
+        self.docs = OrderedDict()
+        self.ids = dict()
+        self.queries = OrderedDict()
+        self.postings = defaultdict(lambda: array('i'))
+        self.length = 0
+        self.dead = 0
+        self.next_id = 0
+        self.journal = None
+        self.lines = 0
+        self.lock_file = None
+        self.unsaved = False
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.docs)
+
+    def open(self):
+        """
+        Load the journal left by a previous run and open it for appending,
+        unless another worker is writing it.
+        """
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.lock_file = open(self.path + '.lock', 'a')
+        lines = 0
+        if os.path.exists(self.path):
+            with self._lock:
+                for entry in read_journal(self.path):
+                    lines += 1
+                    try:
+                        if 'q' in entry:
+                            self.remember(entry['q'].encode('utf-8'), entry['u'])
+                        else:
+                            self.insert(*entry['d'])
+                    except (AttributeError, KeyError, TypeError):
+                        # A damaged line that still reads as JSON.
+                        continue
+        self.lines = lines
+        if not self.take_journal():
+            logging.info('localindex: %s is written by another worker, waiting for it', self.path)
+        self.compact()
+
+    def take_journal(self):
+        """
+        Become the writer of the journal, if no other worker is.
+
+        @rtype:  bool
+        @return: Whether this worker writes the journal now.
+        """
+        try:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            return False
+        with self._lock:
+            self.journal = gzip.open(self.path, 'ab')
+        return True
+
+    def close(self):
+        with self._lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            if self.lock_file is not None:
+                self.lock_file.close()
+                self.lock_file = None
+
+    def add(self, key, groups, exact=True):
+        """
+        Index the results of a query.
+
+        @type  key: str
+        @param key: Cache key of the query, see L{cache.cache_key}.
+
+        @type  groups: list
+        @param groups: Result groups, see L{gosearch.get_search_result}.
+
+        @type  exact: bool
+        @param exact: Remember the results as the answer to the query, i.e.
+            they are its first page.
+        """
+        entries = list()
+        links = list()
+        with self._lock:
+            for i in RESULT_GROUPS:
+                for item in groups[i]:
+                    link = item['link']
+                    if self.link_filter is not None:
+                        link = follow_link(self.link_filter, link) or link
+                    if not link:
+                        continue
+                    link = canonical_url(link)
+                    if not isinstance(link, type(u'')):
+                        link = link.decode('utf-8')
+                    doc = (link, item['title'], item.get('desc', u''), item.get('dlink', u''))
+                    if self.insert(*doc):
+                        entries.append({'d': doc})
+                    links.append(link)
+            if exact and links:
+                self.remember(key, links)
+                entries.append({'q': key.decode('utf-8'), 'u': links})
+            self.write(entries)
+        if self.journal is None and self.lock_file is not None:
+            self.take_journal()
+        self.compact()
+
+    def insert(self, link, title, desc, dlink):
+        # Add or refresh one result. Returns False if it was indexed as is.
+        docid = self.ids.get(link)
+        if docid is not None:
+            doc = self.docs.pop(docid)
+            if doc[1] == title and doc[2] == desc:
+                self.docs[docid] = doc
+                return False
+            self.drop(docid, doc)
+        docid = self.next_id
+        self.next_id += 1
+        terms = tokenize(title, True) * TITLE_WEIGHT + tokenize(desc)
+        for term in terms:
+            self.postings[term].append(docid)
+        self.docs[docid] = (link, title, desc, dlink, len(terms))
+        self.ids[link] = docid
+        self.length += len(terms)
+        while len(self.docs) > self.capacity:
+            self.drop(*self.docs.popitem(last=False))
+        return True
+
+    def drop(self, docid, doc):
+        # The postings keep the number until they are rebuilt.
+        self.docs.pop(docid, None)
+        if self.ids.get(doc[0]) == docid:
+            del self.ids[doc[0]]
+        self.length -= doc[4]
+        self.dead += 1
+
+    def remember(self, key, links):
+        self.queries.pop(key, None)
+        self.queries[key] = links
+        while len(self.queries) > self.capacity:
+            self.queries.popitem(last=False)
+
+    def write(self, entries):
+        if not entries:
+            return
+        if self.journal is None:
+            # Written in full once this worker gets the journal.
+            self.unsaved = True
+            return
+        data = b''.join(json.dumps(entry, sort_keys=True).encode('utf-8') + b'\n' for entry in entries)
+        try:
+            self.journal.write(data)
+            self.journal.flush()
+            self.lines += len(entries)
+        except (IOError, OSError) as e:
+            logging.warning('localindex: cannot write %s: %s', self.path, e)
+
+    def compact(self):
+        """
+        Rebuild the postings once half of their entries are dead, and
+        rewrite the journal once it holds twice as many lines as needed, or
+        when it lacks what was added before this worker could write it.
+        """
+        with self._lock:
+            if self.dead > len(self.docs):
+                postings = defaultdict(lambda: array('i'))
+                for docid, doc in self.docs.items():
+                    for term in tokenize(doc[1], True) * TITLE_WEIGHT + tokenize(doc[2]):
+                        postings[term].append(docid)
+                self.postings = postings
+                self.dead = 0
+
+            live = len(self.docs) + len(self.queries)
+            if self.journal is None or (self.lines <= max(2 * live, 1000) and not self.unsaved):
+                return
+            temp = '%s.%d' % (self.path, os.getpid())
+            try:
+                with gzip.open(temp, 'wb') as f:
+                    for doc in self.docs.values():
+                        f.write(json.dumps({'d': doc[:4]}).encode('utf-8') + b'\n')
+                    for key, links in self.queries.items():
+                        f.write(json.dumps({'q': key.decode('utf-8'), 'u': links}).encode('utf-8') + b'\n')
+                self.journal.close()
+                os.rename(temp, self.path)
+            except (IOError, OSError) as e:
+                logging.warning('localindex: cannot rewrite %s: %s', self.path, e)
+                return
+            finally:
+                if self.journal.closed:
+                    self.journal = gzip.open(self.path, 'ab')
+            self.lines = live
+            self.unsaved = False
+
+    def search(self, key, query, limit=10):
+        """
+        @type  key: str
+        @param key: Cache key of the query.
+
+        @type  query: unicode
+        @param query: Query as typed.
+
+        @rtype:  tuple
+        @return: Up to C{limit} results as dicts with C{title}, C{link},
+            C{dlink} and C{desc}, best first, and whether they are the ones
+            Google gave for this very query.
+        """
+        with self._lock:
+            links = self.queries.get(key)
+            if links:
+                docs = [self.docs[self.ids[link]] for link in links if link in self.ids]
+                if docs:
+                    return [self.record(doc) for doc in docs[:limit]], True
+
+            count = len(self.docs)
+            if not count:
+                return [], False
+            average = float(self.length) / count
+            scores = defaultdict(float)
+            for term in set(tokenize(query)):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                frequencies = defaultdict(int)
+                for docid in postings:
+                    if docid in self.docs:
+                        frequencies[docid] += 1
+                if not frequencies:
+                    continue
+                idf = math.log(1 + (count - len(frequencies) + 0.5) / (len(frequencies) + 0.5))
+                for docid, tf in frequencies.items():
+                    norm = K1 * (1 - B + B * self.docs[docid][4] / average)
+                    scores[docid] += idf * tf * (K1 + 1) / (tf + norm)
+            best = sorted(scores, key=scores.get, reverse=True)[:limit]
+            return [self.record(self.docs[docid]) for docid in best], False
+
+    def record(self, doc):
+        return {'link': doc[0], 'title': doc[1], 'desc': doc[2], 'dlink': doc[3]}
+
+    def stats(self):
+        return {'docs': len(self.docs), 'queries': len(self.queries),
+                'terms': len(self.postings), 'dead': self.dead, 'journal': self.lines}
+
+
+# Read back the entries of a journal file, skipping a damaged tail.
+def read_journal(path):
+    with gzip.open(path, 'rb') as f:
+        while True:
+            try:
+                line = f.readline()
+            except (IOError, EOFError, zlib.error):
+                # The server was killed in the middle of a write, or the
+                # file was damaged.
+                break
+            if not line:
+                break
+            try:
+                yield json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
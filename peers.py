@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PigFly, Open Source Google Search Solution
+#    Copyright (C) 2014-2020 WENS FOOD GROUP (<http://www.wens.com.cn>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#    Authored by Shengli Hu <hushengli@gmail.com>
+__author__ = 'Shengli Hu'
+__all__ = ['HashRing', 'Peers', 'peers']
+
+import bisect
+import hashlib
+import socket
+import struct
+import threading
+import time
+
+
+# Addresses the given host:port nodes resolve to.
+def node_addresses(nodes):
+    addresses = set()
+    for node in nodes:
+        host = node.rsplit(':', 1)[0].strip('[]')
+        try:
+            for info in socket.getaddrinfo(host, None):
+                addresses.add(info[4][0])
+        except socket.gaierror:
+            continue
+    return addresses
+
+
+# Position of a key on the ring.
+def ring_hash(key):
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return struct.unpack('>I', hashlib.md5(key).digest()[:4])[0]
+
+
+class HashRing(object):
+    """
+    Consistent hash ring of the pigfly nodes.
+
+    Every node is placed on the ring C{replicas} times. A key belongs to
+    the first node found clockwise from its own position, so adding or
+    removing a node only moves the keys next to its points.
+    """
+
+    def __init__(self, nodes=(), replicas=100):
+        """
+        @type  nodes: list of str
+        @param nodes: Node addresses, as host:port.
+
+        @type  replicas: int
+        @param replicas: Points per node on the ring.
+        """
+        self.replicas = replicas
+        self.nodes = list()
+        self.points = list()
+        self.owners = list()
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.append(node)
+        for i in range(self.replicas):
+            point = ring_hash('%s#%d' % (node, i))
+            j = bisect.bisect(self.points, point)
+            self.points.insert(j, point)
+            self.owners.insert(j, node)
+
+    def owner(self, key):
+        """
+        @rtype:  str
+        @return: Node the key belongs to, C{None} if the ring is empty.
+        """
+        if not self.points:
+            return None
+        i = bisect.bisect(self.points, ring_hash(key)) % len(self.points)
+        return self.owners[i]
+
+
+class Peers(object):
+    """
+    The other pigfly nodes sharing their result caches with this one.
+
+    Each normalized query is owned by one node of the ring. The other
+    nodes ask the owner for it instead of asking Google, so a popular
+    query is fetched once for the whole group. A peer that cannot be
+    reached is left out for C{down_time} seconds, its queries are then
+    fetched locally.
+    """
+
+    def __init__(self, nodes=(), me=None, down_time=30):
+        """
+        @type  nodes: list of str
+        @param nodes: Every node of the group, this one included, as
+            host:port. Every node must be given the same list.
+
+        @type  me: str
+        @param me: Address of this node in C{nodes}.
+
+        @type  down_time: float
+        @param down_time: Seconds an unreachable peer is left out.
+        """
+        self.ring = HashRing(nodes)
+        self.me = me
+        self.addresses = node_addresses(node for node in nodes if node != me)
+        self.down_time = down_time
+        self.down = dict()
+        self._lock = threading.Lock()
+
+    def configure(self, nodes, me):
+        self.ring = HashRing(nodes)
+        self.me = me
+        self.addresses = node_addresses(node for node in nodes if node != me)
+
+    def is_peer(self, address):
+        """
+        @rtype:  bool
+        @return: Whether the IP address is that of another node of the ring,
+            as resolved when the ring was configured.
+        """
+        return address in self.addresses
+
+    def owner(self, key):
+        """
+        @rtype:  str
+        @return: Peer to ask for the key, or C{None} to fetch it locally:
+            this node owns it, there are no peers, or the owner is down.
+        """
+        node = self.ring.owner(key)
+        if node is None or node == self.me:
+            return None
+        with self._lock:
+            until = self.down.get(node)
+            if until is not None:
+                if until > time.time():
+                    return None
+                del self.down[node]
+        return node
+
+    def mark_down(self, node):
+        with self._lock:
+            self.down[node] = time.time() + self.down_time
+
+
+# The peer group of this process, empty unless configured.
+peers = Peers()
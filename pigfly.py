@@ -21,48 +21,677 @@
 __author__ = 'Shengli Hu'
 import os
 import re
+import hmac
+import time
+import socket
+import atexit
+import signal
 import logging
+import tornado.gen
 import tornado.httpserver
 import tornado.ioloop
 import tornado.web
 import tornado.httpclient
-from gosearch import by_replace_page
-from gosearch import filter_result
+import tornado.netutil
+import tornado.template
+import gosearch
+from concurrent.futures import ThreadPoolExecutor
+from tornado.escape import utf8, to_unicode, json_decode, json_encode, url_escape, xhtml_escape
+from accesslog import AccessLog
+from admission import Admission, Overloaded
+from assets import DiskCache, asset_key
+from cache import LRUCache, cache_key
+from cassette import Cassette
+from gosearch import GROUPS, filter_result, search_pipeline
+from gosearch import fetch_asset, is_asset, load_parser
+from introspect import allocations, object_counts, sample_stacks
+from localindex import LocalIndex
+from peers import peers
+from prefetch import Prewarmer, Speculator
+from resolver import resolver
+from snapshot import load_snapshot, save_snapshot
+from suggest import PrefixIndex
+from upstream import CircuitOpen, UpstreamTimeout, breaker, budget
 from tornado.options import define, options  
 
 define("port", default=8000, help="Run server on a specific port", type=int)  
+define("cache_size", default=1024, help="Number of search results kept in memory", type=int)
+define("cache_ttl", default=600, help="Seconds a cached search result stays fresh", type=int)
+define("click_beacon", default=False, help="Log result clicks with an asynchronous ping beacon", type=bool)
+define("upstream_rate", default=1.0, help="Requests per second sent to Google", type=float)
+define("upstream_burst", default=30, help="Requests that may be sent to Google in a burst", type=int)
+define("prewarm_top", default=20, help="Number of popular queries kept warm, 0 to disable", type=int)
+define("prewarm_interval", default=60, help="Seconds between two prewarm rounds", type=int)
+define("prewarm_log", default="", help="Comma separated log files to seed query popularity from", type=str)
+define("search_timeout", default=20.0, help="Seconds a search may take before it fails with 504", type=float)
+define("connect_timeout", default=5.0, help="Seconds allowed to connect to Google", type=float)
+define("read_timeout", default=15.0, help="Seconds allowed for each read from Google", type=float)
+define("hedge", default=False, help="Send a second request when Google is slower than usual", type=bool)
+define("page_size", default=40, help="Results per page of /search", type=int)
+define("prefetch_reserve", default=10, help="Upstream tokens left to users when prefetching the next page", type=float)
+define("speculate", default=0, help="Related searches of each page fetched ahead of the users, 0 to disable", type=int)
+define("speculate_share", default=0.1, help="Share of the upstream rate and burst speculative fetches may use", type=float)
+define("max_inflight", default=0, help="Searches going upstream at once, --search_workers if 0", type=int)
+define("search_queue", default=32, help="Searches waiting for a free slot before new ones get 503", type=int)
+define("client_rate", default=0.5, help="Uncached searches per second allowed to each client", type=float)
+define("client_burst", default=10, help="Uncached searches each client may send in a burst", type=int)
+define("xheaders", default=False, help="Take the client address from X-Real-Ip set by the proxy in front", type=bool)
+define("front_proxy", default="127.0.0.1,::1", help="Comma separated addresses of the proxy in front, the only ones whose X-Real-Ip is trusted", type=str)
+define("search_workers", default=8, help="Number of searches sent to Google at the same time", type=int)
+define("dns_ttl", default=300, help="Seconds upstream addresses are cached when their TTL is unknown", type=int)
+define("dns_prefer", default="", help="Address family tried first when connecting upstream, ipv4 or ipv6", type=str)
+define("suggest_log", default="", help="Comma separated log files the query suggestions are built from", type=str)
+define("warm_queries", default="", help="Comma separated queries fetched into the cache at startup", type=str)
+define("peers", default="", help="Comma separated host:port of every node sharing the result cache, this one included", type=str)
+define("peer_self", default="", help="host:port of this node in --peers, 127.0.0.1 and --port by default", type=str)
+define("peer_timeout", default=25.0, help="Seconds allowed to a peer for a result, fetching it from Google included", type=float)
+define("peer_connect_timeout", default=1.0, help="Seconds allowed to connect to a peer before it is marked down", type=float)
+define("asset_dir", default="cache/assets", help="Folder Google's images are cached in, empty to leave them on Google", type=str)
+define("asset_cost", default=0.1, help="Uncached searches an uncached image counts for in the per-client limits", type=float)
+define("asset_max_bytes", default=256 * 1024 * 1024, help="Size of the image cache before the least recently used are removed", type=int)
+define("cassette", default="", help="Gzipped file the requests to Google are recorded to or replayed from", type=str)
+define("cassette_mode", default="replay", help="record to send requests to Google and save them, replay to answer them from --cassette", type=str)
+define("replay_speed", default=1.0, help="Share of the recorded latency reproduced on replay, 0 to answer at once", type=float)
+define("reuse_port", default=False, help="Bind with SO_REUSEPORT, so a new worker can start next to the old one", type=bool)
+define("drain_timeout", default=30.0, help="Seconds the requests being served get to finish on SIGTERM", type=float)
+define("pid_file", default="", help="File the pid is written to once the worker is ready", type=str)
+define("snapshot", default="", help="Gzipped file the hot cache entries are saved to and loaded from at startup", type=str)
+define("snapshot_interval", default=60, help="Seconds between two cache snapshots, 0 to only save on SIGTERM and SIGUSR1", type=int)
+define("local_index", default="cache/index.jsonl.gz", help="Journal of the local index searched while Google is unavailable, empty to disable", type=str)
+define("local_index_size", default=50000, help="Results kept in the local index", type=int)
+define("admin_token", default="", help="Token required by the /admin handlers, which are off without it", type=str)
+define("access_log", default="", help="JSON lines access log file, empty to log through the logging module", type=str)
+define("access_log_max_bytes", default=64 * 1024 * 1024, help="Size the access log is rotated at", type=int)
+define("access_log_backups", default=5, help="Number of rotated access logs kept", type=int)
 
-class MainHandler(tornado.web.RequestHandler):
+# Request records, written out by a background thread.
+access_log = AccessLog()
+
+# Search results rewritten by the pipeline, and the result pages rendered from them.
+result_cache = LRUCache(capacity=1024, ttl=600)
+page_cache = LRUCache(capacity=256)
+
+# Structured results extracted from the same fetches.
+record_cache = LRUCache(capacity=1024, ttl=600)
+
+# Decoded /url targets.
+goto_cache = LRUCache(capacity=4096)
+
+# Every result seen, searched when Google is not. Off until --local_index is opened.
+local_index = LocalIndex(link_filter=filter_result)
+
+# Images of the results pages, kept on disk. Off until --asset_dir is opened.
+asset_cache = DiskCache(path=None)
+
+# Query suggestions for the search box, from past queries.
+suggest_index = PrefixIndex()
+
+# Searches run on these threads, so a slow Google never blocks the IOLoop.
+search_executor = ThreadPoolExecutor(max_workers=8)
+
+# Bounds the searches going upstream, overall and per client.
+admission = Admission()
+
+# Addresses of the proxy in front, see BaseHandler.client.
+front_proxies = frozenset(['127.0.0.1', '::1'])
+
+# Runs the profiler of the admin handlers.
+admin_executor = ThreadPoolExecutor(max_workers=1)
+
+# Writes the cache snapshots.
+snapshot_executor = ThreadPoolExecutor(max_workers=1)
+
+# Reads and fetches the images of the asset cache.
+asset_executor = ThreadPoolExecutor(max_workers=4)
+
+# Cache key of one page of results. The first page keeps the bare query key.
+def page_key(key, start=0):
+    if not start:
+        return key
+    return key + b'#' + str(start).encode('ascii')
+
+
+# Fetch the search result for a query from Google.
+def search_page(query, timings=None, deadline=None, start=0):
+    beacon = '/click?q=%s' if options.click_beacon else None
+    assets = '/asset?u=%s' if asset_cache.path else None
+    if deadline is None:
+        deadline = time.time() + options.search_timeout
+    # One fetch gives both the page and the structured results.
+    views = search_pipeline(query, ('page', 'records'), tld='com', lang='zh', num=options.page_size,
+                            start=start, beacon=beacon, timings=timings, deadline=deadline,
+                            hedge=options.hedge, assets=assets)
+    record_cache.set(page_key(cache_key(query), start), {'records': views['records'], 'next': views['next']})
+    if local_index.path:
+        local_index.add(cache_key(query), views['records'], exact=not start)
+    suggest_index.add_related(views['records'])
+    return views['page']
+
+
+# Searches sent to Google, by cache key, so concurrent misses share one fetch.
+inflight = dict()
+
+
+# Fetch the search result for a query once, however many requests want it.
+def single_flight(key, query, timings=None, deadline=None, start=0, executor=None):
+    future = inflight.get(key)
+    if future is None:
+        future = (executor or search_executor).submit(search_page, query, timings, deadline, start)
+        inflight[key] = future
+
+        def landed(future):
+            del inflight[key]
+            if future.exception() is None:
+                result_cache.set(key, future.result())
+        tornado.ioloop.IOLoop.current().add_future(future, landed)
+    return future
+
+
+# Ask the peer owning a query for its result. The owner may have to fetch
+# it from Google, only connecting is expected to be quick.
+@tornado.gen.coroutine
+def ask_peer(peer, query, deadline, start=0):
+    timeout = min(options.peer_timeout, max(0.1, deadline - time.time()))
+    response = yield tornado.httpclient.AsyncHTTPClient().fetch(
+        'http://%s/peer?q=%s&start=%d' % (peer, url_escape(query), start),
+        connect_timeout=min(options.peer_connect_timeout, timeout), request_timeout=timeout)
+    raise tornado.gen.Return([utf8(blob) for blob in json_decode(response.body)['result']])
+
+
+# Whether a peer could not be reached at all, as opposed to being slow to
+# answer. Tornado gives 599 for both kinds of timeout, and raises socket
+# errors as they are.
+def peer_unreachable(error):
+    if isinstance(error, tornado.httpclient.HTTPError):
+        return error.code == 599 and error.message != 'Timeout during request'
+    return isinstance(error, socket.error)
+
+
+# Get the result of a cache miss, from the owning peer or from Google.
+@tornado.gen.coroutine
+def lookup(key, query, timings=None, deadline=None, start=0):
+    """
+    @rtype:  tuple
+    @return: The result, and the peer it came from or C{None}.
+
+    @raise IOError: Google could not be searched, see L{search_page}.
+    """
+    peer = peers.owner(key)
+    if peer is not None:
+        started = time.time()
+        try:
+            result = yield ask_peer(peer, query, deadline, start)
+        except Exception as e:
+            logging.warning('peer %s failed: %s', peer, e)
+            if peer_unreachable(e):
+                peers.mark_down(peer)
+            elif getattr(e, 'code', None) == 599:
+                # The owner is fetching it, a second fetch would not be faster.
+                raise UpstreamTimeout('peer %s did not answer in time' % peer)
+        else:
+            timings['peer'] = time.time() - started
+            result_cache.set(key, result)
+            raise tornado.gen.Return((result, peer))
+
+    if breaker.retry_after():
+        raise CircuitOpen('upstream suspended')
+    result = yield single_flight(key, query, timings, deadline, start)
+    raise tornado.gen.Return((result, None))
+
+
+# Fetch the next page of results in the background, if the budget allows.
+def prefetch_page(key, query, start):
+    if draining or key in inflight or result_cache.get(key) is not None or breaker.retry_after():
+        return
+    if not budget.allows(1, options.prefetch_reserve):
+        return
+    single_flight(key, query, start=start, executor=prewarmer.executor)
+
+
+# Images being read or fetched, by asset key, so each is fetched once.
+asset_inflight = dict()
+
+
+# Read an image from the asset cache, fetching it from Google on a miss.
+def load_asset(key, url):
+    cached = asset_cache.get(key)
+    if cached is not None:
+        return cached
+    deadline = time.time() + options.search_timeout
+    body, content_type = fetch_asset(url, deadline)
+    return body, asset_cache.set(key, body, {'type': content_type})
+
+
+# Load an image once, however many requests want it.
+def single_flight_asset(key, url):
+    future = asset_inflight.get(key)
+    if future is None:
+        future = asset_executor.submit(load_asset, key, url)
+        asset_inflight[key] = future
+
+        def landed(future):
+            del asset_inflight[key]
+        tornado.ioloop.IOLoop.current().add_future(future, landed)
+    return future
+
+
+# Refresh a popular query, joining the search of a user for it if any.
+def prewarm(key):
+    return single_flight(key, key, executor=prewarmer.executor)
+
+
+# Refreshes the popular queries before they expire from the result cache.
+prewarmer = Prewarmer(result_cache, prewarm, budget)
+
+
+# Speculation waits while users' searches are queueing or use half the slots.
+def upstream_busy():
+    return bool(admission.waiters) or admission.active * 2 >= admission.capacity or breaker.retry_after()
+
+
+# Fetch a related search into the result cache, ahead of the users.
+def speculate(key, query):
+    return single_flight(key, query, executor=speculator.executor)
+
+
+# Fetches the related searches users are likely to click next.
+speculator = Speculator(speculate, budget, busy=upstream_busy)
+
+# Placeholders rendered into result.html once at startup. The rendered shell is
+# split around them, so each page is only the static fragments and the blobs.
+PAGE_SLOTS = ['<!--pigfly:slot:%d-->' % i for i in range(4)]
+page_fragments = None
+
+# Served instead of results when Google is unavailable and nothing is cached.
+DEGRADED_NOTICE = u'<p class="degraded">谷歌暂时无法访问，请稍后再试。</p>'
+LOCAL_NOTICE = u'<p class="degraded">谷歌暂时无法访问，以下是本地保存的结果。</p>'
+degraded_page = None
+index_page = None
+
+# Set once the worker is warm.
+ready = False
+
+
+# Load the parser, open the session with Google and fetch the canned queries.
+def warm_up(queries):
+    load_parser()
+    deadline = time.time() + options.search_timeout
+    try:
+        gosearch.open_session('com', deadline)
+    except Exception as e:
+        logging.warning('warm up: cannot reach Google: %s', e)
+    for keywords in queries:
+        query = utf8(keywords)
+        # Loaded from the snapshot of the previous worker.
+        if result_cache.get(cache_key(query)) is not None:
+            continue
+        try:
+            result_cache.set(cache_key(query), search_page(query))
+        except Exception as e:
+            logging.warning('warm up: %s failed: %s', keywords, e)
+
+
+@tornado.gen.coroutine
+def start_warm_up(queries):
+    global ready
+    started = time.time()
+    yield search_executor.submit(warm_up, queries)
+    ready = True
+    logging.info('warm up: ready after %.1fs', time.time() - started)
+    if options.pid_file:
+        # Tells a restart script the new worker is taking traffic.
+        with open(options.pid_file, 'w') as f:
+            f.write('%d\n' % os.getpid())
+
+
+# Caches handed over to the next worker, and how their values are read back.
+def snapshot_caches():
+    return {'result': result_cache, 'records': record_cache}
+
+SNAPSHOT_DECODERS = {'result': lambda result: [utf8(blob) for blob in result]}
+
+
+# Save the hot cache entries, off the IOLoop.
+@tornado.gen.coroutine
+def write_snapshot():
+    started = time.time()
+    try:
+        count = yield snapshot_executor.submit(save_snapshot, options.snapshot, snapshot_caches(),
+                                               options.cache_size)
+    except Exception as e:
+        logging.warning('snapshot: cannot write %s: %s', options.snapshot, e)
+    else:
+        logging.info('snapshot: %d entries written in %.1fs', count, time.time() - started)
+
+
+# Requests being served, waited for before the worker exits.
+active_requests = set()
+
+# Set once SIGTERM is received.
+draining = False
+
+
+# Stop taking connections, let the requests being served finish, and hand
+# the hot cache entries over to the next worker.
+@tornado.gen.coroutine
+def shutdown(http_server):
+    global ready
+    ready = False
+    http_server.stop()
+    prewarmer.stop()
+    speculator.stop()
+    deadline = time.time() + options.drain_timeout
+    while (active_requests or inflight) and time.time() < deadline:
+        yield tornado.gen.sleep(0.1)
+    if active_requests or inflight:
+        logging.warning('drain: %d requests and %d searches cut short', len(active_requests), len(inflight))
+    if options.snapshot:
+        yield write_snapshot()
+    yield http_server.close_all_connections()
+    tornado.ioloop.IOLoop.current().stop()
+
+
+def on_sigterm(signum, frame):
+    global draining
+    io_loop = tornado.ioloop.IOLoop.instance()
+    if draining:
+        # A second SIGTERM does not wait for the requests.
+        io_loop.add_callback_from_signal(io_loop.stop)
+        return
+    draining = True
+    logging.info('drain: stopping, waiting up to %.0fs for %d requests',
+                 options.drain_timeout, len(active_requests))
+    io_loop.add_callback_from_signal(shutdown, http_server)
+
+
+def on_sigusr1(signum, frame):
+    if options.snapshot:
+        tornado.ioloop.IOLoop.instance().add_callback_from_signal(write_snapshot)
+
+
+# Remove the pid file, unless a newer worker has written its own already.
+def remove_pid_file():
+    try:
+        with open(options.pid_file) as f:
+            pid = int(f.read().strip() or 0)
+        if pid == os.getpid():
+            os.remove(options.pid_file)
+    except (IOError, OSError, ValueError):
+        pass
+
+
+# Templates are compiled once and rendered outside of any request.
+template_loader = tornado.template.Loader(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Render a template that only depends on the static files.
+def render_static(settings, template, **kwargs):
+    static_url = lambda path: tornado.web.StaticFileHandler.make_static_url(settings, path)
+    return template_loader.load(template).generate(static_url=static_url, **kwargs)
+
+
+# Render the result.html shell once and split it into static byte fragments.
+def build_page_fragments(settings, template="template/result.html"):
+    html = render_static(settings, template, result=PAGE_SLOTS)
+    fragments = list()
+    for slot in PAGE_SLOTS:
+        fragment, html = html.split(utf8(slot), 1)
+        fragments.append(fragment)
+    fragments.append(html)
+    return fragments
+
+
+# Assemble a result page from the static fragments, the search result blobs
+# and the pager. The blobs are UTF-8 already, only the pager is encoded.
+def render_page(result, pager=u''):
+    parts = [page_fragments[0]]
+    for blob, fragment in zip(list(result) + [pager], page_fragments[1:]):
+        parts.append(utf8(blob))
+        parts.append(fragment)
+    return b''.join(parts)
+
+
+# Links to the previous and next pages of results.
+def render_pager(keywords, start, num, more=True):
+    link = u'<li class="%s"><a href="/search?q=%s&amp;start=%d">%s</a></li>'
+    items = list()
+    if start:
+        items.append(link % ('previous', url_escape(keywords), max(0, start - num), u'上一页'))
+    if more:
+        items.append(link % ('next', url_escape(keywords), start + num, u'下一页'))
+    return u'<ul class="pager">%s</ul>' % u''.join(items)
+
+# Results found by the local index, in the markup of Google's result lists.
+def render_local(hits):
+    item = u'<li class="g"><h3 class="r"><a href="%s">%s</a></h3><cite>%s</cite><span class="st">%s</span></li>'
+    items = [item % (xhtml_escape(hit['link']), xhtml_escape(hit['title']),
+                     xhtml_escape(hit['dlink']), xhtml_escape(hit['desc'])) for hit in hits]
+    return LOCAL_NOTICE + u'<ol class="local">%s</ol>' % u''.join(items)
+
+
+# Search the local index for a query Google could not answer.
+def search_local(keywords, limit):
+    if not local_index.path:
+        return [], False
+    return local_index.search(cache_key(utf8(keywords)), keywords, limit)
+
+# Hand the finished request over to the access log.
+def log_request(handler):
+    record = {
+        'ts': round(time.time(), 3),
+        'ip': handler.request.remote_ip,
+        'method': handler.request.method,
+        'path': handler.request.path,
+        'status': handler.get_status(),
+        'ms': round(handler.request.request_time() * 1000, 1),
+        'bytes': getattr(handler, 'bytes_out', 0),
+    }
+    record.update(getattr(handler, 'log_fields', ()))
+    access_log.write(record)
+
+
+class BaseHandler(tornado.web.RequestHandler):
+    def initialize(self):
+        # Extra fields of the access log record for this request.
+        self.log_fields = dict()
+        self.bytes_out = 0
+        active_requests.add(self)
+
+    def on_finish(self):
+        active_requests.discard(self)
+
+    def on_connection_close(self):
+        active_requests.discard(self)
+        super(BaseHandler, self).on_connection_close()
+
+    # Address of the other end of the connection, whatever the headers say.
+    def socket_address(self):
+        address = self.request.connection.context.address
+        return address[0] if isinstance(address, tuple) else address
+
+    # Address the per-client limits apply to. Only the front proxy is
+    # trusted with X-Real-Ip. Without it, requests through the proxy all come
+    # from its address, which is not one client but all of them, so it has
+    # no limit of its own.
+    def client(self):
+        address = self.socket_address()
+        if address not in front_proxies:
+            return address
+        ip = self.request.remote_ip if options.xheaders else address
+        return None if ip == address else ip
+
+    def write(self, chunk):
+        if isinstance(chunk, dict):
+            self.set_header("Content-Type", "application/json; charset=UTF-8")
+            chunk = json_encode(chunk)
+        chunk = utf8(chunk)
+        self.bytes_out += len(chunk)
+        super(BaseHandler, self).write(chunk)
+
+
+class MainHandler(BaseHandler):
     def get(self):
-        self.render("template/index.html")
+        self.finish(index_page)
 
 
-class GotoHandler(tornado.web.RequestHandler):
+class HealthzHandler(BaseHandler):
     def get(self):
-        url = '/url?q='+self.get_argument('q')
-	url = filter_result(url)
-        if not url:
-            url = '/'
-        logging.info(self.request.remote_ip+'\tgoto:\t' + url)
+        self.finish('ok')
+
+
+class ReadyzHandler(BaseHandler):
+    # Ready once the warm up is over, so the proxy only sends us warm traffic.
+    def get(self):
+        if not ready:
+            self.set_status(503)
+            self.finish('warming up')
+            return
+        self.finish('ready')
+
+
+class GotoHandler(BaseHandler):
+    def get(self):
+        # Result links now point straight at their destinations, this only
+        # serves old cached pages and links that could not be decoded.
+        q = self.get_argument('q')
+        url = goto_cache.get(q)
+        if url is None:
+            url = filter_result(q) or '/'
+            goto_cache.set(q, url)
+        self.log_fields['goto'] = url
         self.redirect(url)
 
 
-class SearchHandler(tornado.web.RequestHandler):
-    @tornado.web.asynchronous
+class ClickHandler(BaseHandler):
+    # Browsers send the ping beacon without our xsrf cookie.
+    def check_xsrf_cookie(self):
+        pass
+
+    def post(self):
+        self.log_fields['click'] = self.get_argument('q')
+        self.set_status(204)
+
+
+class SearchHandler(BaseHandler):
+    # First result of the page asked for, from the start or the page argument.
+    def get_start(self):
+        num = options.page_size
+        try:
+            start = int(self.get_argument('start', 0))
+            if not start:
+                start = (int(self.get_argument('page', 1)) - 1) * num
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        return min(max(0, start), 990) // num * num
+
+    # The result for one page of a query, from the caches, a peer or Google.
+    @tornado.gen.coroutine
+    def find_result(self, keywords, start, timings):
+        """
+        @rtype:  tuple
+        @return: Cache key of the page and its result.
+
+        @raise IOError: Google could not be searched and nothing is cached.
+        """
+        deadline = time.time() + options.search_timeout
+        self.log_fields['query'] = keywords
+        if start:
+            self.log_fields['start'] = start
+        # Encoded once, the cache keys and the searches use the bytes.
+        self.query = query = utf8(keywords)
+        key = page_key(cache_key(query), start)
+
+        # Queries owned by a peer are kept warm by that peer.
+        if not start and peers.owner(key) is None:
+            prewarmer.record(key)
+        speculator.used(key)
+        result = result_cache.get(key)
+        if result is None:
+            self.log_fields['cache'] = 'miss'
+            try:
+                # Joining a search already in flight costs Google nothing.
+                if key in inflight:
+                    result, peer = yield lookup(key, query, timings, deadline, start)
+                else:
+                    asked = time.time()
+                    granted = yield admission.acquire(self.client(), deadline)
+                    timings['queue'] = granted - asked
+                    try:
+                        result, peer = yield lookup(key, query, timings, deadline, start)
+                    finally:
+                        admission.release(granted)
+            except IOError as e:
+                # Google is failing or blocking us, fall back to what we had.
+                self.log_fields['error'] = str(e)
+                result = result_cache.get_stale(key)
+                if result is None:
+                    raise
+                self.log_fields['cache'] = 'stale'
+            else:
+                if peer is not None:
+                    self.log_fields['cache'] = 'peer'
+                    self.log_fields['peer'] = peer
+        else:
+            self.log_fields['cache'] = 'hit'
+        suggest_index.add(keywords)
+        raise tornado.gen.Return((key, result))
+
+    # Once a page is served, the next one and the related searches are
+    # likely to be asked for.
+    def prefetch_next(self, start, more, records=None):
+        if more:
+            after = start + options.page_size
+            prefetch_page(page_key(cache_key(self.query), after), self.query, after)
+        if records and not start and options.speculate:
+            related = list()
+            for item in records['records'][4] + records['records'][5]:
+                query = utf8(item['title'])
+                key = cache_key(query)
+                if key not in inflight and peers.owner(key) is None and result_cache.get(key) is None:
+                    related.append((key, query))
+            speculator.offer(related[:options.speculate])
+
+    @tornado.gen.coroutine
     def get(self):
-        # google the result
         keywords = self.get_argument("q")
-        #if keywords:
-        #    p = re.compile('[\s]+')
-        #    # keywords = p.sub('+', keywords)
-        #    keywords, number = p.subn('+', keywords)
+        start = self.get_start()
+        timings = dict()
+        try:
+            key, result = yield self.find_result(keywords, start, timings)
+        except IOError as e:
+            self.degraded(e)
+            return
+        records = record_cache.get_stale(key)
+        more = records['next'] if records else True
 
-        logging.info(self.request.remote_ip +'\tsearch for:\t'+keywords)
-        query = keywords.encode('utf-8')
-        # entries = list()
-        # (style1, style2, table) = by_replace_page(keywords,stop=30)
+        # The rendered page is reused for as long as its result stays cached.
+        page = page_cache.get(key)
+        if page is None or page[0] is not result:
+            started = time.time()
+            page = (result, render_page(result, render_pager(keywords, start, options.page_size, more)))
+            page_cache.set(key, page)
+            timings['render'] = time.time() - started
+        self.log_fields['stages'] = dict((k, round(v * 1000, 1)) for k, v in timings.items())
+        self.finish(page[1])
+        self.prefetch_next(start, more, records)
 
-        self.render("template/result.html", result=by_replace_page(query,tld='com',lang='zh',num=40,stop=30,pause=0))
+    # Set the status and Retry-After for a search that could not be served.
+    def unavailable(self, error):
+        self.set_status(504 if isinstance(error, UpstreamTimeout) else 503)
+        retry_after = getattr(error, 'retry_after', None) or breaker.retry_after()
+        if retry_after:
+            self.set_header('Retry-After', int(retry_after) + 1)
+
+    def degraded(self, error):
+        # Answer from the results seen before, if any match.
+        hits, exact = ([], False) if self.get_start() else search_local(self.get_argument('q'), options.page_size)
+        if hits:
+            self.log_fields['error'] = str(error)
+            self.log_fields['cache'] = 'local'
+            self.finish(render_page([u'', u'', render_local(hits)]))
+            return
+        self.unavailable(error)
+        self.finish(degraded_page)
 
     def on_response(self, response):
         if response.error:
@@ -71,22 +700,296 @@ class SearchHandler(tornado.web.RequestHandler):
         #json = tornado.escape.json_decode(response.body)
         pass
 
+class ApiSearchHandler(SearchHandler):
+    # The structured results of one page, as JSON.
+    @tornado.gen.coroutine
+    def get(self):
+        keywords = self.get_argument("q")
+        start = self.get_start()
+        try:
+            key, result = yield self.find_result(keywords, start, dict())
+            records = record_cache.get_stale(key)
+            if records is None:
+                # The page came from a peer or an old cache entry without its
+                # records, only Google has them.
+                if breaker.retry_after():
+                    raise CircuitOpen('upstream suspended')
+                deadline = time.time() + options.search_timeout
+                if key in inflight:
+                    yield single_flight(key, self.query, None, deadline, start)
+                else:
+                    granted = yield admission.acquire(self.client(), deadline)
+                    try:
+                        yield single_flight(key, self.query, None, deadline, start)
+                    finally:
+                        admission.release(granted)
+                records = record_cache.get_stale(key)
+        except IOError as e:
+            hits, exact = search_local(keywords, options.page_size) if not start else ([], False)
+            if hits:
+                self.log_fields['cache'] = 'local'
+                response = {'q': keywords, 'start': start, 'num': options.page_size, 'next': False,
+                            'local': True, 'exact': exact, 'error': str(e)}
+                response.update((name, list()) for name in GROUPS)
+                response['main_items'] = hits
+                self.finish(response)
+                return
+            self.unavailable(e)
+            self.finish({'q': keywords, 'start': start, 'error': str(e)})
+            return
+        response = {'q': keywords, 'start': start, 'num': options.page_size, 'next': records['next']}
+        response.update(zip(GROUPS, records['records']))
+        self.finish(response)
+        self.prefetch_next(start, records['next'], records)
+
+
+class PeerHandler(BaseHandler):
+    # Asked by the other nodes for queries this node owns on the ring. The
+    # query is never passed on to a third node, so a ring that is not the
+    # same on every node cannot make requests go round in circles.
+    # Only routed with --peers, and only the other nodes may use it, it
+    # skips the per-client limits.
+    def prepare(self):
+        if not peers.is_peer(self.socket_address()):
+            raise tornado.web.HTTPError(403)
+
+    @tornado.gen.coroutine
+    def get(self):
+        keywords = self.get_argument('q')
+        try:
+            start = min(max(0, int(self.get_argument('start', 0))), 990)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        self.log_fields['peer_query'] = keywords
+        query = utf8(keywords)
+        key = page_key(cache_key(query), start)
+        if not start:
+            prewarmer.record(key)
+        result = result_cache.get(key)
+        if result is None:
+            self.log_fields['cache'] = 'miss'
+            try:
+                if breaker.retry_after():
+                    raise CircuitOpen('upstream suspended')
+                # Peers limit their own clients, only the overall cap applies.
+                deadline = time.time() + options.search_timeout
+                if key in inflight:
+                    result = yield single_flight(key, query, None, deadline, start)
+                else:
+                    granted = yield admission.acquire(None, deadline)
+                    try:
+                        result = yield single_flight(key, query, None, deadline, start)
+                    finally:
+                        admission.release(granted)
+            except IOError as e:
+                self.log_fields['error'] = str(e)
+                result = result_cache.get_stale(key)
+                if result is None:
+                    raise tornado.web.HTTPError(503)
+                self.log_fields['cache'] = 'stale'
+        else:
+            self.log_fields['cache'] = 'hit'
+        self.finish({'result': [to_unicode(blob) for blob in result]})
+
+
+class AssetHandler(BaseHandler):
+    # A cached image never changes, browsers keep it for 30 days and only
+    # revalidate it with If-None-Match after that.
+    @tornado.gen.coroutine
+    def get(self):
+        url = self.get_argument('u')
+        if not asset_cache.path or not is_asset(url):
+            raise tornado.web.HTTPError(403)
+        key = asset_key(url)
+        self.set_header('Cache-Control', 'public, max-age=2592000')
+
+        # Revalidation is answered from the index, without reading the file.
+        self.etag = asset_cache.etag(key)
+        if self.etag is not None:
+            self.set_etag_header()
+            if self.check_etag_header():
+                self.log_fields['cache'] = 'hit'
+                self.set_status(304)
+                self.finish()
+                return
+            self.clear_header('Etag')
+        try:
+            if self.etag is None and key not in asset_inflight:
+                admission.charge(self.client(), options.asset_cost)
+            body, header = yield single_flight_asset(key, url)
+        except Overloaded as e:
+            self.log_fields['error'] = str(e)
+            self.clear_header('Cache-Control')
+            self.set_status(503)
+            self.set_header('Retry-After', int(e.retry_after) + 1)
+            self.finish()
+            return
+        except IOError as e:
+            self.log_fields['error'] = str(e)
+            raise tornado.web.HTTPError(404 if getattr(e, 'code', None) == 404 else 502)
+        self.log_fields['cache'] = 'hit' if self.etag else 'miss'
+        self.etag = header['etag']
+        self.set_header('Content-Type', header['type'])
+        self.finish(body)
+
+    def compute_etag(self):
+        return getattr(self, 'etag', None)
+
+
+class SuggestHandler(BaseHandler):
+    # Answered from memory, Google is never asked for suggestions.
+    def get(self):
+        prefix = self.get_argument('q', '')
+        self.set_header('Cache-Control', 'max-age=60')
+        self.finish({'q': prefix, 'suggestions': suggest_index.suggest(prefix)})
+
+
+class AdminHandler(BaseHandler):
+    # Only reachable with --admin_token, sent as X-Admin-Token or ?token=.
+    def prepare(self):
+        token = self.request.headers.get('X-Admin-Token') or self.get_argument('token', '')
+        if not options.admin_token or not hmac.compare_digest(utf8(token), utf8(options.admin_token)):
+            raise tornado.web.HTTPError(404)
+
+
+class ProfileHandler(AdminHandler):
+    # Sample the live worker for a few seconds and return folded stacks.
+    @tornado.gen.coroutine
+    def get(self):
+        try:
+            seconds = min(float(self.get_argument('seconds', 10)), 60)
+            interval = max(float(self.get_argument('interval', 0.005)), 0.001)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        try:
+            stacks = yield admin_executor.submit(sample_stacks, seconds, interval)
+        except RuntimeError as e:
+            raise tornado.web.HTTPError(409, str(e))
+        self.set_header('Content-Type', 'text/plain; charset=UTF-8')
+        self.finish('\n'.join(stacks) + '\n')
+
+
+class MemoryHandler(AdminHandler):
+    def get(self):
+        trace = self.get_argument('trace', None)
+        try:
+            limit = int(self.get_argument('limit', 20))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        self.finish({
+            'allocations': allocations(limit, {'1': True, '0': False}.get(trace)),
+            'objects': object_counts(limit),
+            'caches': {
+                'result': {'entries': len(result_cache),
+                           'bytes': sum(sum(len(blob) for blob in result) for result in result_cache.values())},
+                'page': {'entries': len(page_cache),
+                         'bytes': sum(len(page[1]) for page in page_cache.values())},
+                'records': {'entries': len(record_cache)},
+                'goto': {'entries': len(goto_cache)},
+                'asset': asset_cache.stats(),
+            },
+            'budget': budget.available(),
+            'breaker': breaker.state,
+            'admission': admission.stats(),
+            'speculation': speculator.stats(),
+            'local_index': local_index.stats(),
+            'cassette': gosearch.cassette.stats() if gosearch.cassette else None,
+        })
+
+
 settings = {
     "static_path": os.path.join(os.path.dirname(__file__), "static"),
     "cookie_secret": "342ezKXQAGaYdkL5gEmGeJJFuYh7EQnp2XdTP1o/Vo=",
     "login_url": "/login",
     "xsrf_cookies": True,
     "debug": False,
+    "log_function": log_request,
 }
 application = tornado.web.Application([
     (r"/", MainHandler),
+    (r"/healthz", HealthzHandler),
+    (r"/readyz", ReadyzHandler),
+    (r"/admin/profile", ProfileHandler),
+    (r"/admin/memory", MemoryHandler),
     (r"/url", GotoHandler),
+    (r"/click", ClickHandler),
     (r"/search", SearchHandler),
+    (r"/api/search", ApiSearchHandler),
+    (r"/suggest", SuggestHandler),
+    (r"/asset", AssetHandler),
     (r"/static/(.*)", tornado.web.StaticFileHandler, dict(path=settings['static_path'])),
 ], **settings)
 
+page_fragments = build_page_fragments(settings)
+index_page = render_static(settings, "template/index.html")
+degraded_page = render_page([u'', u'', DEGRADED_NOTICE])
+
 if __name__ == '__main__':
-    http_server = tornado.httpserver.HTTPServer(application)
     tornado.options.parse_command_line()
-    http_server.listen(options.port)  
-    tornado.ioloop.IOLoop.instance().start()
+    http_server = tornado.httpserver.HTTPServer(application, xheaders=options.xheaders)
+    result_cache.capacity = options.cache_size
+    result_cache.ttl = options.cache_ttl
+    record_cache.capacity = options.cache_size
+    record_cache.ttl = options.cache_ttl
+    access_log.path = options.access_log or None
+    access_log.max_bytes = options.access_log_max_bytes
+    access_log.backups = options.access_log_backups
+    access_log.start()
+    atexit.register(access_log.close)
+    search_executor = ThreadPoolExecutor(max_workers=options.search_workers)
+    admission.capacity = options.max_inflight or options.search_workers
+    admission.queue_size = options.search_queue
+    admission.rate = options.client_rate
+    admission.burst = options.client_burst
+    front_proxies = frozenset(filter(None, options.front_proxy.split(',')))
+    resolver.ttl = options.dns_ttl
+    resolver.prefer = options.dns_prefer or None
+    tornado.netutil.Resolver.configure('tornado.netutil.ThreadedResolver')
+    gosearch.connect_timeout = options.connect_timeout
+    gosearch.read_timeout = options.read_timeout
+    if options.cassette:
+        gosearch.cassette = Cassette(options.cassette, options.cassette_mode, options.replay_speed)
+        gosearch.cassette.open()
+        atexit.register(gosearch.cassette.close)
+    if options.local_index:
+        local_index.path = options.local_index
+        local_index.capacity = options.local_index_size
+        local_index.open()
+        atexit.register(local_index.close)
+    if options.asset_dir:
+        asset_cache.path = options.asset_dir
+        asset_cache.max_bytes = options.asset_max_bytes
+        asset_cache.open()
+    budget.rate = options.upstream_rate
+    budget.burst = options.upstream_burst
+    if options.peers:
+        peers.configure(options.peers.split(','), options.peer_self or '127.0.0.1:%d' % options.port)
+        application.add_handlers(r'.*$', [(r"/peer", PeerHandler)])
+    for path in filter(None, options.suggest_log.split(',')):
+        suggest_index.load_log(path)
+    if options.prewarm_top:
+        prewarmer.top = options.prewarm_top
+        prewarmer.interval = options.prewarm_interval
+        for path in filter(None, options.prewarm_log.split(',')):
+            prewarmer.load_log(path)
+        prewarmer.start()
+    if options.speculate:
+        speculator.reserve = options.prefetch_reserve
+        speculator.share = options.speculate_share
+        speculator.start()
+    if options.snapshot:
+        loaded = load_snapshot(options.snapshot, snapshot_caches(), SNAPSHOT_DECODERS)
+        logging.info('snapshot: loaded %s', loaded)
+        if options.snapshot_interval:
+            tornado.ioloop.PeriodicCallback(write_snapshot, options.snapshot_interval * 1000).start()
+    if options.pid_file:
+        atexit.register(remove_pid_file)
+    signal.signal(signal.SIGTERM, on_sigterm)
+    signal.signal(signal.SIGUSR1, on_sigusr1)
+    # Bound once everything is loaded: with --reuse_port the kernel hands
+    # connections to a worker as soon as it listens.
+    sockets = tornado.netutil.bind_sockets(options.port, reuse_port=options.reuse_port)
+    http_server.add_sockets(sockets)
+    io_loop = tornado.ioloop.IOLoop.instance()
+    io_loop.add_callback(start_warm_up, filter(None, options.warm_queries.split(',')))
+    io_loop.start()
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PigFly, Open Source Google Search Solution
+#    Copyright (C) 2014-2020 WENS FOOD GROUP (<http://www.wens.com.cn>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#    Authored by Shengli Hu <hushengli@gmail.com>
+__author__ = 'Shengli Hu'
+__all__ = ['SpaceSaving', 'Prewarmer', 'Speculator']
+
+import logging
+import threading
+import time
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import tornado.ioloop
+
+from accesslog import read_queries
+from cache import cache_key
+from upstream import TokenBucket
+
+
+class SpaceSaving(object):
+    """
+    Space-Saving heavy hitters counter.
+
+    Tracks the most frequent items of a stream in bounded memory: at most
+    C{capacity} counters are kept, and a new item takes over the smallest
+    counter when they are all in use.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = dict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def offer(self, item, count=1):
+        with self._lock:
+            if item in self.counts:
+                self.counts[item] += count
+            elif len(self.counts) < self.capacity:
+                self.counts[item] = count
+            else:
+                smallest = min(self.counts, key=self.counts.get)
+                self.counts[item] = self.counts.pop(smallest) + count
+
+    def top(self, n):
+        """
+        @rtype:  list of tuple
+        @return: The C{n} most frequent items as (item, count), most
+            frequent first.
+        """
+        with self._lock:
+            items = sorted(self.counts.items(), key=lambda x: x[1], reverse=True)
+        return items[:n]
+
+    def decay(self, factor=0.5):
+        """
+        Scale every counter down so that old popularity fades away.
+        """
+        with self._lock:
+            for item in list(self.counts):
+                count = self.counts[item] * factor
+                if count < 1:
+                    del self.counts[item]
+                else:
+                    self.counts[item] = count
+
+
+class Prewarmer(object):
+    """
+    Keeps the most popular queries warm in the result cache.
+
+    Every C{interval} seconds the C{top} queries are checked, and the ones
+    about to expire are fetched again in the background, as long as the
+    upstream budget has room to spare for them and for the refreshes still
+    waiting for a worker.
+    """
+
+    def __init__(self, cache, fetch, budget, top=20, interval=60, ahead=120,
+                 reserve=10, cost=2, workers=2):
+        """
+        @type  cache: L{cache.LRUCache}
+        @param cache: Result cache to keep warm.
+
+        @type  fetch: callable
+        @param fetch: Fetches the result for a cache key into the cache,
+            on L{executor}. Returns a future.
+
+        @type  budget: L{upstream.TokenBucket}
+        @param budget: Shared upstream rate budget.
+
+        @type  top: int
+        @param top: Number of popular queries kept warm.
+
+        @type  interval: float
+        @param interval: Seconds between two refresh rounds.
+
+        @type  ahead: float
+        @param ahead: Refresh entries expiring within this many seconds.
+
+        @type  reserve: float
+        @param reserve: Tokens left in the budget for user searches.
+
+        @type  cost: int
+        @param cost: Upstream requests needed by one fetch.
+
+        @type  workers: int
+        @param workers: Background fetches run at the same time.
+        """
+        self.cache = cache
+        self.fetch = fetch
+        self.budget = budget
+        self.top = top
+        self.interval = interval
+        self.ahead = ahead
+        self.reserve = reserve
+        self.cost = cost
+        self.counter = SpaceSaving(capacity=max(1000, top * 50))
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = set()
+        self.rounds = 0
+        self.timer = None
+
+    def record(self, key):
+        self.counter.offer(key)
+
+    def load_log(self, path):
+        """
+        Seed the query counters from a pigfly access log or tornado log.
+        """
+        try:
+            for query in read_queries(path):
+                self.record(cache_key(query.encode('utf-8')))
+        except IOError as e:
+            logging.warning('prewarm: cannot read %s: %s', path, e)
+
+    def start(self):
+        self.timer = tornado.ioloop.PeriodicCallback(self.refresh, self.interval * 1000)
+        self.timer.start()
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.stop()
+        self.executor.shutdown(wait=False)
+
+    def refresh(self):
+        deadline = time.time() + self.ahead
+        for key, count in self.counter.top(self.top):
+            if key in self.pending:
+                continue
+            expires = self.cache.expires(key)
+            if expires is not None and expires > deadline:
+                continue
+            # Nothing is spent until the queued refreshes run, count them.
+            if not self.budget.allows(self.cost * (len(self.pending) + 1), self.reserve):
+                break
+            self.pending.add(key)
+            tornado.ioloop.IOLoop.current().add_future(
+                self.fetch(key), lambda future, key=key: self.landed(key, future))
+
+        # Let popularity follow the traffic of the day.
+        self.rounds += 1
+        if self.rounds % 60 == 0:
+            self.counter.decay()
+
+    def landed(self, key, future):
+        self.pending.discard(key)
+        if future.exception() is not None:
+            logging.warning('prewarm: %s failed: %s', key, future.exception())
+
+
+class Speculator(object):
+    """
+    Fetches the related searches of the pages served before users click them.
+
+    Related searches are queued newest first, and fetched in the background
+    within their own share of the upstream rate. Nothing is fetched while
+    the users' searches are queueing or the budget is short, and the oldest
+    queued searches are dropped when the queue is full.
+    """
+
+    def __init__(self, fetch, budget, share=0.1, reserve=10, busy=None, queue_size=100,
+                 interval=1.0, tracked=1000, workers=1):
+        """
+        @type  fetch: callable
+        @param fetch: Fetches a query into the result cache, given its cache
+            key and the query. Returns a future.
+
+        @type  budget: L{upstream.TokenBucket}
+        @param budget: Shared upstream rate budget.
+
+        @type  share: float
+        @param share: Share of the rate and burst of the budget that may be
+            spent on speculation.
+
+        @type  reserve: float
+        @param reserve: Tokens left in the budget for user searches.
+
+        @type  busy: callable
+        @param busy: Returns C{True} while speculation should hold back.
+
+        @type  queue_size: int
+        @param queue_size: Related searches waiting to be fetched.
+
+        @type  interval: float
+        @param interval: Seconds between two looks at the queue.
+
+        @type  tracked: int
+        @param tracked: Speculated keys remembered to measure the hit rate.
+
+        @type  workers: int
+        @param workers: Speculative fetches run at the same time.
+        """
+        self.fetch = fetch
+        self.budget = budget
+        self.share = share
+        self.reserve = reserve
+        self.busy = busy
+        self.interval = interval
+        self.tracked = tracked
+        self.queue = deque(maxlen=queue_size)
+        self.queued = set()
+        self.speculated = OrderedDict()
+        self.allowance = None
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.timer = None
+        self.counts = dict(offered=0, dropped=0, deferred=0, fetched=0, failed=0, hits=0)
+
+    def start(self):
+        # The share is taken from the budget as configured at startup.
+        self.allowance = TokenBucket(self.budget.rate * self.share, max(1, self.budget.burst * self.share))
+        self.timer = tornado.ioloop.PeriodicCallback(self.run, self.interval * 1000)
+        self.timer.start()
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer = None
+        self.executor.shutdown(wait=False)
+
+    def offer(self, items):
+        """
+        Queue searches for speculative fetching, the first ones first.
+
+        @type  items: list of tuple
+        @param items: Cache key and query of each search.
+        """
+        if self.timer is None:
+            return
+        for key, query in reversed(items):
+            if key in self.queued or key in self.speculated:
+                continue
+            if len(self.queue) == self.queue.maxlen:
+                self.queued.discard(self.queue.pop()[0])
+                self.counts['dropped'] += 1
+            self.queue.appendleft((key, query))
+            self.queued.add(key)
+            self.counts['offered'] += 1
+
+    def run(self):
+        while self.queue:
+            if self.busy is not None and self.busy():
+                self.counts['deferred'] += 1
+                return
+            if not self.allowance.allows(1) or not self.budget.allows(1, self.reserve):
+                return
+            key, query = self.queue.popleft()
+            self.queued.discard(key)
+            self.allowance.spend()
+            self.track(key)
+            self.counts['fetched'] += 1
+            tornado.ioloop.IOLoop.current().add_future(
+                self.fetch(key, query), lambda future, key=key: self.landed(key, future))
+
+    def track(self, key):
+        self.speculated[key] = time.time()
+        while len(self.speculated) > self.tracked:
+            self.speculated.popitem(last=False)
+
+    def landed(self, key, future):
+        if future.exception() is not None:
+            self.counts['failed'] += 1
+            self.speculated.pop(key, None)
+
+    def used(self, key):
+        """
+        Count a user search for the key, if it was fetched speculatively.
+        Each speculative fetch counts as a hit once at most.
+        """
+        if self.speculated.pop(key, None) is not None:
+            self.counts['hits'] += 1
+
+    def stats(self):
+        stats = dict(self.counts, queued=len(self.queue))
+        fetched = self.counts['fetched'] - self.counts['failed']
+        stats['hit_rate'] = round(float(self.counts['hits']) / fetched, 3) if fetched > 0 else None
+        return stats
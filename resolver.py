@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PigFly, Open Source Google Search Solution
+#    Copyright (C) 2014-2020 WENS FOOD GROUP (<http://www.wens.com.cn>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#    Authored by Shengli Hu <hushengli@gmail.com>
+__author__ = 'Shengli Hu'
+__all__ = ['DnsCache', 'happy_connect', 'resolver']
+
+import errno
+import select
+import socket
+import threading
+import time
+
+# Lazy import of dnspython, used to read the record TTLs when installed.
+dns_resolver = None
+
+# connect_ex() results meaning the connection is still being set up.
+IN_PROGRESS = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+
+class DnsCache(object):
+    """
+    In-process cache of the addresses of the upstream hosts.
+
+    Entries are kept for the TTL of the DNS records when dnspython is
+    installed, or C{ttl} seconds otherwise. Each lookup returns the
+    addresses rotated by one, so connections spread over every frontend
+    the name resolves to.
+    """
+
+    def __init__(self, ttl=300, min_ttl=30, prefer=None):
+        """
+        @type  ttl: float
+        @param ttl: Seconds the addresses are kept, if the TTL is unknown.
+
+        @type  min_ttl: float
+        @param min_ttl: Lower bound for the TTL of the records.
+
+        @type  prefer: str
+        @param prefer: C{'ipv4'} or C{'ipv6'} to try that family first.
+            Use C{None} to keep the order of getaddrinfo.
+        """
+        self.ttl = ttl
+        self.min_ttl = min_ttl
+        self.prefer = prefer
+        self.entries = dict()
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """
+        @rtype:  list of tuple
+        @return: getaddrinfo() results for the host, the two families
+            interleaved for happy eyeballs.
+        """
+        key = (host, port)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                addrs = entry[1]
+                entry[2] = (entry[2] + 1) % len(addrs)
+                return addrs[entry[2]:] + addrs[:entry[2]]
+
+        addrs = interleave(socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM), self.prefer)
+        if not addrs:
+            raise socket.gaierror('no address for %s' % host)
+        ttl = record_ttl(host)
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self.entries[key] = [time.time() + max(self.min_ttl, ttl), addrs, 0]
+        return addrs
+
+    def invalidate(self, host, port):
+        with self._lock:
+            self.entries.pop((host, port), None)
+
+
+# Order addresses alternating between IPv6 and IPv4, as RFC 8305 suggests.
+def interleave(addrs, prefer=None):
+    v6 = [a for a in addrs if a[0] == socket.AF_INET6]
+    v4 = [a for a in addrs if a[0] != socket.AF_INET6]
+    first, second = v6, v4
+    if prefer == 'ipv4' or (prefer is None and addrs and addrs[0][0] != socket.AF_INET6):
+        first, second = v4, v6
+    result = list()
+    for i in range(max(len(first), len(second))):
+        result.extend(first[i:i + 1])
+        result.extend(second[i:i + 1])
+    return result
+
+
+# Shortest TTL of the A and AAAA records of a host, or None if unknown.
+def record_ttl(host):
+    global dns_resolver
+    if dns_resolver is None:
+        try:
+            import dns.resolver as dns_resolver
+        except ImportError:
+            dns_resolver = False
+    if not dns_resolver:
+        return None
+    lookup = getattr(dns_resolver, 'resolve', None) or dns_resolver.query
+    ttls = list()
+    for rdtype in ('A', 'AAAA'):
+        try:
+            answer = lookup(host, rdtype)
+        except Exception:
+            continue
+        ttls.append(answer.rrset.ttl)
+    return min(ttls) if ttls else None
+
+
+# Connect to the first of several addresses that answers.
+def happy_connect(addrs, timeout=None, delay=0.25):
+    """
+    Connect to one of the given addresses, happy eyeballs style.
+
+    A connection attempt is started on the next address every C{delay}
+    seconds, or as soon as the previous attempt fails, and the first
+    attempt to succeed wins.
+
+    @type  addrs: list of tuple
+    @param addrs: getaddrinfo() results, in the order to try them.
+
+    @type  timeout: float
+    @param timeout: Seconds allowed for the whole connection.
+
+    @type  delay: float
+    @param delay: Seconds to wait before starting the next attempt.
+
+    @rtype:  socket
+    @return: Connected socket, in blocking mode.
+
+    @raise socket.timeout: No address answered in time.
+    @raise socket.error: Every address refused the connection.
+    """
+    now = time.time()
+    deadline = now + timeout if timeout is not None else None
+    attempts = dict()
+    error = None
+    i = 0
+    next_attempt = now
+    try:
+        while True:
+            now = time.time()
+            if i < len(addrs) and (now >= next_attempt or not attempts):
+                family, socktype, proto, canonname, sockaddr = addrs[i]
+                i += 1
+                sock = socket.socket(family, socktype, proto)
+                sock.setblocking(False)
+                err = sock.connect_ex(sockaddr)
+                if err in IN_PROGRESS:
+                    attempts[sock] = sockaddr
+                    next_attempt = now + delay
+                else:
+                    sock.close()
+                    error = socket.error(err, '%s: %s' % (sockaddr, errno.errorcode.get(err, err)))
+                continue
+
+            if not attempts:
+                raise error or socket.error('no address to connect to')
+            if deadline is not None and now >= deadline:
+                raise socket.timeout('timed out')
+            wait = None
+            if i < len(addrs):
+                wait = next_attempt - now
+            if deadline is not None:
+                wait = deadline - now if wait is None else min(wait, deadline - now)
+            ignored, writable, ignored = select.select([], list(attempts), [], wait)
+            for sock in writable:
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                sockaddr = attempts.pop(sock)
+                if err:
+                    sock.close()
+                    error = socket.error(err, '%s: %s' % (sockaddr, errno.errorcode.get(err, err)))
+                    continue
+                sock.setblocking(True)
+                return sock
+    finally:
+        for sock in attempts:
+            sock.close()
+
+
+# Addresses of the upstream hosts, shared by all connections of this process.
+resolver = DnsCache()
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PigFly, Open Source Google Search Solution
+#    Copyright (C) 2014-2020 WENS FOOD GROUP (<http://www.wens.com.cn>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#    Authored by Shengli Hu <hushengli@gmail.com>
+__author__ = 'Shengli Hu'
+__all__ = ['rewrite_page', 'STRIP_RULES', 'KEEP_RULES']
+
+import codecs
+import re
+import sys
+
+if sys.version_info[0] > 2:
+    from html import escape
+    from html.parser import HTMLParser
+    from urllib.parse import quote
+else:
+    from cgi import escape
+    from HTMLParser import HTMLParser
+    from urllib import quote
+
+# Elements removed from the Google result page. Each rule matches either
+#   {'id': x}                 the element with id x,
+#   {'tag': t}                every <t> element,
+#   {'within': x, 'tag': t, 'count': n}
+#                             the first n <t> elements inside #x,
+#   {'within': x, 'tag': t, 'child': i}
+#                             the i-th child element of the first <t> inside #x.
+STRIP_RULES = (
+    # del top
+    {'id': 'gb'},
+    {'within': 'mn', 'tag': 'tr', 'count': 3},
+    # del left
+    {'id': 'leftnav'},
+    # del right
+    {'within': 'desktop-search', 'tag': 'tr', 'child': 1},
+    # del bottom
+    {'id': 'bfl'},
+    {'id': 'fll'},
+    # del script
+    {'tag': 'script'},
+)
+
+# Elements kept from what is left, as (tag, how many), in output order.
+KEEP_RULES = (
+    ('style', 2),
+    ('table', 1),
+)
+
+# Attributes holding Google redirect links, as (tag, attribute). These are
+# replaced by their decoded destination.
+LINK_RULES = (
+    ('a', 'href'),
+)
+
+# Attributes holding images served by Google, as (tag, attribute). These are
+# replaced by the local URL the asset filter gives for them.
+ASSET_RULES = (
+    ('img', 'src'),
+)
+
+# Elements that never have an end tag.
+VOID_ELEMENTS = frozenset([
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen',
+    'link', 'meta', 'param', 'source', 'track', 'wbr',
+])
+
+# Open elements implicitly closed by the start of another element.
+IMPLIED_END = {
+    'p': ('p',),
+    'li': ('li',),
+    'dt': ('dt', 'dd'),
+    'dd': ('dt', 'dd'),
+    'option': ('option',),
+    'td': ('td', 'th'),
+    'th': ('td', 'th'),
+    'tr': ('tr', 'td', 'th'),
+}
+
+# Elements whose text is copied verbatim instead of whitespace-collapsed.
+VERBATIM = frozenset(['pre', 'textarea'])
+
+whitespace = re.compile(r'\s+')
+
+# Destinations a result link may be pointed at. Anything else, e.g. a
+# javascript: URL hidden in /url?q=, keeps going through the redirect.
+link_schemes = re.compile(r'https?://', re.I)
+meta_charset = re.compile(br'<meta[^>]+charset=["\']?([\w-]+)', re.I)
+
+# Size of the chunks fed to the parser, so it can stop once all is kept.
+CHUNK_SIZE = 16384
+
+
+class PageRewriter(HTMLParser):
+    """
+    Single pass rewriter for Google result pages.
+
+    Applies the strip rules while tokenizing and copies the kept elements
+    to compact, unindented buffers. Nothing else is materialized.
+    """
+
+    def __init__(self, strip_rules=STRIP_RULES, keep_rules=KEEP_RULES,
+                 link_filter=None, beacon=None, asset_filter=None):
+        if sys.version_info[0] > 2:
+            HTMLParser.__init__(self, convert_charrefs=False)
+        else:
+            HTMLParser.__init__(self)
+        self.strip_rules = strip_rules
+        self.keep_rules = keep_rules
+
+        # Stack of open elements.
+        self.stack = list()
+
+        # Stack depth of the element being removed or kept, if any.
+        self.strip_depth = None
+        self.keep_depth = None
+
+        # Per strip rule: depth of its #within anchor, matches so far, and
+        # for child rules the depth of the parent and children seen.
+        self.anchors = [None] * len(strip_rules)
+        self.matches = [0] * len(strip_rules)
+        self.parents = [None] * len(strip_rules)
+        self.children = [0] * len(strip_rules)
+
+        self.kept = dict((tag, list()) for tag, count in keep_rules)
+        self.keep_counts = dict(keep_rules)
+        self.buffer = None
+        self.verbatim = 0
+
+        # Decodes redirect links, and the optional click beacon URL template.
+        self.link_filter = link_filter
+        self.link_attrs = dict(LINK_RULES)
+        self.beacon = beacon
+
+        # Maps Google hosted images to local URLs.
+        self.asset_filter = asset_filter
+        self.asset_attrs = dict(ASSET_RULES)
+
+    @property
+    def done(self):
+        for tag, count in self.keep_rules:
+            if len(self.kept[tag]) < count:
+                return False
+        return self.keep_depth is None
+
+    def result(self):
+        """
+        @rtype:  list of unicode
+        @return: Kept elements, in the order given by the keep rules. Missing
+            elements are returned as empty strings.
+        """
+        result = list()
+        for tag, count in self.keep_rules:
+            kept = self.kept[tag]
+            for i in range(count):
+                result.append(kept[i] if i < len(kept) else u'')
+        return result
+
+    def emit(self, text):
+        if self.buffer is not None and self.strip_depth is None:
+            self.buffer.append(text)
+
+    def match(self, tag, attrs):
+        depth = len(self.stack)
+        for i, rule in enumerate(self.strip_rules):
+            within = rule.get('within')
+            if within is None:
+                if rule.get('id') is not None and rule['id'] == attrs.get('id'):
+                    return True
+                if rule.get('tag') == tag:
+                    return True
+                continue
+            if self.anchors[i] is None:
+                if attrs.get('id') == within:
+                    self.anchors[i] = depth
+                continue
+            if 'child' in rule:
+                if self.parents[i] is None:
+                    if tag == rule['tag'] and not self.matches[i]:
+                        self.parents[i] = depth
+                        self.matches[i] = 1
+                elif depth == self.parents[i] + 1:
+                    self.children[i] += 1
+                    if self.children[i] == rule['child'] + 1:
+                        return True
+            elif tag == rule['tag'] and self.matches[i] < rule.get('count', 1):
+                self.matches[i] += 1
+                return True
+        return False
+
+    def push(self, tag, attrs):
+        for implied in IMPLIED_END.get(tag, ()):
+            if self.stack and self.stack[-1] == implied:
+                self.pop()
+                break
+        pairs, attrs = attrs, dict(attrs)
+        if self.strip_depth is None and self.match(tag, attrs):
+            self.strip_depth = len(self.stack)
+        elif self.strip_depth is None and self.keep_depth is None:
+            kept = self.kept.get(tag)
+            if kept is not None and len(kept) < self.keep_counts[tag]:
+                self.keep_depth = len(self.stack)
+                self.buffer = list()
+        if self.buffer is not None and self.strip_depth is None:
+            self.emit(self.rewrite_tag(tag, pairs) or self.get_starttag_text())
+        if tag not in VOID_ELEMENTS:
+            self.stack.append(tag)
+            if tag in VERBATIM:
+                self.verbatim += 1
+        elif self.strip_depth == len(self.stack):
+            self.strip_depth = None
+        elif self.keep_depth == len(self.stack):
+            self.finish_kept(tag)
+
+    # Rebuild the start tag if its links or images are rewritten.
+    def rewrite_tag(self, tag, attrs):
+        links = self.rewrite_links(tag, attrs)
+        assets = self.rewrite_assets(tag, links or attrs)
+        attrs = assets or links
+        if attrs is None:
+            return None
+        parts = [u'<', tag]
+        for key, value in attrs:
+            if value is None:
+                parts.append(u' %s' % key)
+            else:
+                parts.append(u' %s="%s"' % (key, escape(value, True)))
+        parts.append(u'>')
+        return u''.join(parts)
+
+    def rewrite_links(self, tag, attrs):
+        name = self.link_attrs.get(tag)
+        if name is None or self.link_filter is None:
+            return None
+        link = dict(attrs).get(name)
+        if not link or not link.startswith('/url?'):
+            return None
+        target = follow_link(self.link_filter, link)
+        if not target or not link_schemes.match(target):
+            return None
+        attrs = [(key, target if key == name else value) for key, value in attrs]
+        if self.beacon:
+            quoted = quote(target.encode('utf-8') if bytes is str else target, safe='')
+            attrs.append(('ping', self.beacon % quoted))
+        return attrs
+
+    def rewrite_assets(self, tag, attrs):
+        name = self.asset_attrs.get(tag)
+        if name is None or self.asset_filter is None:
+            return None
+        src = dict(attrs).get(name)
+        local = src and self.asset_filter(src)
+        if not local:
+            return None
+        return [(key, local if key == name else value) for key, value in attrs]
+
+    def pop(self):
+        tag = self.stack.pop()
+        depth = len(self.stack)
+        if tag in VERBATIM:
+            self.verbatim -= 1
+        for i, anchor in enumerate(self.anchors):
+            if self.parents[i] == depth:
+                self.parents[i] = None
+            if anchor == depth:
+                self.anchors[i] = None
+        if self.strip_depth == depth:
+            self.strip_depth = None
+        elif self.keep_depth == depth:
+            self.finish_kept(tag)
+
+    def finish_kept(self, tag):
+        self.kept[tag].append(u''.join(self.buffer))
+        self.keep_depth = None
+        self.buffer = None
+
+    def handle_starttag(self, tag, attrs):
+        self.push(tag, attrs)
+
+    def handle_startendtag(self, tag, attrs):
+        self.push(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self.pop()
+
+    def handle_endtag(self, tag):
+        if tag not in self.stack:
+            return
+        while self.stack[-1] != tag:
+            self.pop()
+        self.emit(u'</%s>' % tag)
+        self.pop()
+
+    def handle_data(self, data):
+        if self.buffer is None or self.strip_depth is not None:
+            return
+        if not self.verbatim:
+            data = whitespace.sub(u' ', data)
+        self.emit(data)
+
+    def handle_entityref(self, name):
+        self.emit(u'&%s;' % name)
+
+    def handle_charref(self, name):
+        self.emit(u'&#%s;' % name)
+
+
+# Decode a Google redirect link with a link filter.
+def follow_link(link_filter, link):
+    """
+    @type  link_filter: callable
+    @param link_filter: Decodes a Google redirect link, see
+        L{gosearch.filter_result}.
+
+    @rtype:  str
+    @return: Destination of the link, of the same type as the link, or
+        C{None} if the filter leaves it alone.
+    """
+    if isinstance(link, str):
+        return link_filter(link)
+    # Python 2 only percent-decodes byte strings correctly.
+    target = link_filter(link.encode('utf-8'))
+    return target and target.decode('utf-8', 'replace')
+
+
+# Guess the charset declared by the page itself, if Python knows it.
+def sniff_charset(html, default='utf-8'):
+    m = meta_charset.search(html[:2048])
+    if not m:
+        return default
+    try:
+        return codecs.lookup(m.group(1).decode('ascii')).name
+    except LookupError:
+        return default
+
+
+# Strip the Google result page and keep its styles and main table.
+def rewrite_page(html, charset=None, strip_rules=STRIP_RULES,
+                 keep_rules=KEEP_RULES, link_filter=None, beacon=None,
+                 asset_filter=None, encoding=None):
+    """
+    Rewrite a Google result page in a single streaming pass.
+
+    @type  html: str
+    @param html: Result page as retrieved by get_page, or decoded already.
+
+    @type  charset: str
+    @param charset: Page encoding. Guessed from the page if not given.
+
+    @type  strip_rules: tuple
+    @param strip_rules: Elements to remove, see L{STRIP_RULES}.
+
+    @type  keep_rules: tuple
+    @param keep_rules: Elements to keep, see L{KEEP_RULES}.
+
+    @type  link_filter: callable
+    @param link_filter: Decodes a Google redirect link into its destination,
+        or returns C{None} to leave the link alone. Links are not rewritten
+        if not given.
+
+    @type  beacon: str
+    @param beacon: URL template pinged by the browser when a rewritten link
+        is clicked, with C{%s} standing for the quoted destination.
+
+    @type  asset_filter: callable
+    @param asset_filter: Maps the URL of an image to the local URL it is
+        served from, or returns C{None} to leave it alone.
+
+    @type  encoding: str
+    @param encoding: Encode the kept elements, so they can be written out
+        as they are. Use C{None} to return them as unicode.
+
+    @rtype:  list of unicode, or of str with C{encoding}
+    @return: Compact markup of the kept elements, i.e. [style1, style2, table]
+        with the default rules.
+    """
+    if isinstance(html, bytes):
+        html = html.decode(charset or sniff_charset(html), 'replace')
+    parser = PageRewriter(strip_rules, keep_rules, link_filter, beacon, asset_filter)
+    for i in range(0, len(html), CHUNK_SIZE):
+        parser.feed(html[i:i + CHUNK_SIZE])
+        if parser.done:
+            break
+    else:
+        parser.close()
+    if encoding is not None:
+        return [blob.encode(encoding) for blob in parser.result()]
+    return parser.result()
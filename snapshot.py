@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PigFly, Open Source Google Search Solution
+#    Copyright (C) 2014-2020 WENS FOOD GROUP (<http://www.wens.com.cn>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#    Authored by Shengli Hu <hushengli@gmail.com>
+__author__ = 'Shengli Hu'
+__all__ = ['save_snapshot', 'load_snapshot']
+
+import gzip
+import json
+import logging
+import os
+
+from collections import defaultdict
+
+
+# Byte strings are written out as text, the caches only hold UTF-8.
+def as_text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+# Write the entries of the caches to a file, for the next worker to load.
+def save_snapshot(path, caches, limit=None):
+    """
+    The file is a gzipped JSON lines file, one entry per line, written
+    under a temporary name and renamed so a worker starting at the same
+    time never loads half a snapshot.
+
+    @type  path: str
+    @param path: Snapshot file.
+
+    @type  caches: dict
+    @param caches: L{cache.LRUCache} objects by name. Keys are byte strings,
+        values anything JSON can hold.
+
+    @type  limit: int
+    @param limit: Most recently used entries written for each cache.
+
+    @rtype:  int
+    @return: Number of entries written.
+    """
+    temp = '%s.%d' % (path, os.getpid())
+    count = 0
+    with gzip.open(temp, 'wb') as f:
+        for name in sorted(caches):
+            for key, expires, value in caches[name].snapshot(limit):
+                entry = {'cache': name, 'key': key, 'expires': expires, 'value': value}
+                f.write(json.dumps(entry, default=as_text).encode('utf-8') + b'\n')
+                count += 1
+    os.rename(temp, path)
+    return count
+
+
+# Load the entries written by save_snapshot() into the caches.
+def load_snapshot(path, caches, decoders=None):
+    """
+    @type  decoders: dict
+    @param decoders: By cache name, turns a value read back from JSON into
+        what the cache holds.
+
+    @rtype:  dict
+    @return: Number of entries loaded, by cache name.
+    """
+    if decoders is None:
+        decoders = dict()
+    entries = defaultdict(list)
+    try:
+        with gzip.open(path, 'rb') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                cache = entry.get('cache')
+                if cache not in caches:
+                    continue
+                value = entry['value']
+                if cache in decoders:
+                    value = decoders[cache](value)
+                entries[cache].append((entry['key'].encode('utf-8'), entry['expires'], value))
+    except (IOError, EOFError) as e:
+        # A missing file is a first start. A damaged one still gives what
+        # was read before the damage.
+        if os.path.exists(path):
+            logging.warning('snapshot: cannot read all of %s: %s', path, e)
+    for name, items in entries.items():
+        caches[name].restore(items)
+    return dict((name, len(items)) for name, items in entries.items())
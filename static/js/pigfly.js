@@ -0,0 +1,27 @@
+/* Fill the search box suggestions from /suggest as the user types. */
+(function ($) {
+    var input = $('input[name="q"]');
+    var list = $('#suggestions');
+    var timer = null;
+    var last = '';
+
+    input.on('input', function () {
+        clearTimeout(timer);
+        timer = setTimeout(function () {
+            var q = $.trim(input.val());
+            if (!q || q === last) {
+                return;
+            }
+            last = q;
+            $.getJSON('/suggest', {q: q}, function (data) {
+                if (data.q !== last) {
+                    return;
+                }
+                list.empty();
+                $.each(data.suggestions, function (i, phrase) {
+                    list.append($('<option>').attr('value', phrase));
+                });
+            });
+        }, 100);
+    });
+})(jQuery);
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PigFly, Open Source Google Search Solution
+#    Copyright (C) 2014-2020 WENS FOOD GROUP (<http://www.wens.com.cn>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#    Authored by Shengli Hu <hushengli@gmail.com>
+__author__ = 'Shengli Hu'
+__all__ = ['PrefixIndex']
+
+import bisect
+import heapq
+import logging
+import threading
+
+from accesslog import read_queries
+
+
+# Normalize a phrase the way cache_key() does, on text instead of bytes.
+def normalize(phrase):
+    return u' '.join(phrase.split()).lower()
+
+
+class PrefixIndex(object):
+    """
+    Query suggestions from a sorted array of phrases.
+
+    Lookups find the first phrase with the prefix by binary search, then
+    rank the next few phrases sharing it by weight. Phrases that got heavy
+    are kept in a second, much smaller array that is searched the same way,
+    so popular phrases are found even behind a long run of rare ones. New
+    phrases are inserted in place, so the index is updated as queries come
+    in.
+    """
+
+    def __init__(self, capacity=100000, scan=256, heavy=5):
+        """
+        @type  capacity: int
+        @param capacity: Maximum number of phrases kept. The lightest tenth
+            is dropped when it is exceeded.
+
+        @type  scan: int
+        @param scan: Maximum phrases ranked from each array for one lookup.
+
+        @type  heavy: float
+        @param heavy: Weight from which a phrase joins the heavy array.
+        """
+        self.capacity = capacity
+        self.scan = scan
+        self.heavy = heavy
+        self.keys = list()
+        self.heavy_keys = list()
+        self.phrases = dict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, phrase, weight=1):
+        """
+        @type  phrase: unicode
+        @param phrase: Query or related search, as the user would type it.
+
+        @type  weight: float
+        @param weight: Added to the weight of the phrase.
+        """
+        key = normalize(phrase)
+        if not key:
+            return
+        with self._lock:
+            entry = self.phrases.get(key)
+            if entry is None:
+                entry = self.phrases[key] = [0, u' '.join(phrase.split())]
+                bisect.insort(self.keys, key)
+            if entry[0] < self.heavy <= entry[0] + weight:
+                bisect.insort(self.heavy_keys, key)
+            entry[0] += weight
+            if len(self.keys) > self.capacity:
+                self.prune()
+
+    def add_related(self, result, weight=0.5):
+        """
+        Add the related searches of a L{gosearch.get_search_result} result.
+        """
+        for items in result[4:6]:
+            for item in items:
+                self.add(item['title'], weight)
+
+    def prune(self):
+        ranked = sorted(self.phrases, key=lambda key: self.phrases[key][0])
+        for key in ranked[:len(ranked) // 10 or 1]:
+            del self.phrases[key]
+        self.keys = sorted(self.phrases)
+        self.heavy_keys = [key for key in self.keys if self.phrases[key][0] >= self.heavy]
+
+    def suggest(self, prefix, limit=8):
+        """
+        @type  prefix: unicode
+        @param prefix: What the user typed so far.
+
+        @type  limit: int
+        @param limit: Maximum suggestions returned.
+
+        @rtype:  list of unicode
+        @return: Phrases starting with the prefix, heaviest first.
+        """
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        with self._lock:
+            candidates = dict()
+            for keys in (self.heavy_keys, self.keys):
+                i = bisect.bisect_left(keys, prefix)
+                for key in keys[i:i + self.scan]:
+                    if not key.startswith(prefix):
+                        break
+                    candidates[key] = self.phrases[key]
+            candidates = candidates.values()
+        return [phrase for weight, phrase in heapq.nlargest(limit, candidates)]
+
+    def load_log(self, path):
+        """
+        Add the queries of a pigfly access log or tornado log.
+        """
+        try:
+            for query in read_queries(path):
+                self.add(query)
+        except IOError as e:
+            logging.warning('suggest: cannot read %s: %s', path, e)
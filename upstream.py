@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# PigFly, Open Source Google Search Solution
+#    Copyright (C) 2014-2020 WENS FOOD GROUP (<http://www.wens.com.cn>).
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#    Authored by Shengli Hu <hushengli@gmail.com>
+__author__ = 'Shengli Hu'
+__all__ = ['TokenBucket', 'LatencyTracker', 'CircuitBreaker', 'UpstreamTimeout',
+           'UpstreamBlocked', 'CircuitOpen', 'budget', 'latency', 'breaker']
+
+import threading
+import time
+
+from collections import deque
+
+
+class UpstreamTimeout(IOError):
+    """
+    Google did not answer within the connect or read timeout, or the
+    request could not finish before its deadline.
+    """
+
+
+class UpstreamBlocked(IOError):
+    """
+    Google answered with a captcha or an error page instead of results.
+    """
+
+
+class CircuitOpen(IOError):
+    """
+    Requests to Google are suspended by the circuit breaker.
+    """
+
+
+class TokenBucket(object):
+    """
+    Token bucket refilled at a steady rate up to a burst size.
+
+    Every request sent to Google spends a token. User searches always go
+    through and may run the bucket dry; background work only starts while
+    enough tokens are left over for the users.
+    """
+
+    def __init__(self, rate=1.0, burst=30):
+        """
+        @type  rate: float
+        @param rate: Tokens added per second.
+
+        @type  burst: int
+        @param burst: Maximum number of tokens held.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def spend(self, cost=1):
+        """
+        Take tokens unconditionally. The balance may go negative, down to
+        minus the burst size, which holds background work back until the
+        bucket has recovered.
+        """
+        with self._lock:
+            self._refill()
+            self.tokens = max(-self.burst, self.tokens - cost)
+
+    def allows(self, cost=1, reserve=0):
+        """
+        @rtype:  bool
+        @return: C{True} if C{cost} tokens can be spent while still keeping
+            C{reserve} tokens in the bucket.
+        """
+        with self._lock:
+            self._refill()
+            return self.tokens - cost >= reserve
+
+    def wait(self, cost=1, reserve=0):
+        """
+        Block until L{allows} would return C{True}. The tokens are not
+        taken, the requests spend them as they are sent.
+        """
+        while True:
+            with self._lock:
+                self._refill()
+                missing = cost + reserve - self.tokens
+            if missing <= 0:
+                return
+            time.sleep(missing / self.rate)
+
+    def available(self):
+        with self._lock:
+            self._refill()
+            return self.tokens
+
+
+class LatencyTracker(object):
+    """
+    Recent latencies of the requests sent to Google.
+    """
+
+    def __init__(self, size=200, default=1.0):
+        """
+        @type  size: int
+        @param size: Number of recent samples kept.
+
+        @type  default: float
+        @param default: Value reported until enough samples are collected.
+        """
+        self.samples = deque(maxlen=size)
+        self.default = default
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, p):
+        samples = sorted(self.samples)
+        if len(samples) < 20:
+            return self.default
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+
+class CircuitBreaker(object):
+    """
+    Stops sending requests to Google while it keeps failing or blocking us.
+
+    The breaker opens after C{threshold} failures in a row. While open every
+    request is refused at once. After C{reset_timeout} seconds it lets a
+    single trial request through (half-open): success closes it again,
+    failure keeps it open for another period.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=5, reset_timeout=60):
+        """
+        @type  threshold: int
+        @param threshold: Failures in a row that open the breaker.
+
+        @type  reset_timeout: float
+        @param reset_timeout: Seconds the breaker stays open before a trial.
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.trial = False
+        self._lock = threading.Lock()
+
+    def retry_after(self):
+        """
+        @rtype:  float
+        @return: Seconds until the next trial request, 0 if not open.
+        """
+        if self.state == self.CLOSED:
+            return 0
+        return max(0, self.opened + self.reset_timeout - time.time())
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.time() < self.opened + self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self.trial = False
+            if self.trial:
+                return False
+            self.trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.state = self.OPEN
+                self.opened = time.time()
+            self.trial = False
+
+
+# Requests per second we allow ourselves to send to Google, shared by all
+# upstream fetches of this process.
+budget = TokenBucket()
+
+# Latencies of the requests sent to Google, for the hedging delay.
+latency = LatencyTracker()
+
+# Health of Google as seen from this process.
+breaker = CircuitBreaker()